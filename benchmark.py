@@ -0,0 +1,723 @@
+"""Micro benchmarks for the QR generation pipeline.
+
+Run with ``python benchmark.py <name>``; see ``python benchmark.py --help``.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+import segno
+from PIL import Image, ImageFilter, ImageSequence, ImageStat
+
+# code.py shadows the standard library module of the same name, so load it by path
+_spec = importlib.util.spec_from_file_location('qr_app', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'code.py'))
+app_module = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(app_module)
+
+PAYLOAD = 'https://example.com/campaign?utm_source=print&utm_medium=qr'
+
+
+def synthetic_background(width, height, seed=0):
+    """Returns a deterministic RGB image with gradients and some noise."""
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)[None, :]
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    pixels = np.stack([x + 0 * y, y + 0 * x, (x + y) / 2], axis=-1)
+    pixels += rng.normal(0, 12, pixels.shape)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), 'RGB')
+
+
+def timed(func, repeat):
+    """Runs func repeat times and returns the median wall time in milliseconds."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return float(np.median(samples)) * 1000
+
+
+def bench_compositor(args):
+    """Compares qr.to_artistic with the NumPy compositor on static JPEG backgrounds."""
+    qr = segno.make(PAYLOAD, error='H', boost_error=True)
+    encoded = app_module.EncodedQR(qr)
+    print(f'{"background":>12} {"to_artistic ms":>15} {"compositor ms":>14} {"speedup":>8} {"max diff":>9}')
+    for width, height in [(320, 240), (1024, 768), (1920, 1080), (4000, 3000)]:
+        source = BytesIO()
+        synthetic_background(width, height).save(source, format='JPEG', quality=90)
+
+        def to_artistic():
+            source.seek(0)
+            out = BytesIO()
+            qr.to_artistic(background=source, target=out, scale=12, border=4, kind='jpeg', dark='#000000')
+            return out
+
+        # generate_qr decodes and analyses the background either way, so only the render is timed
+        analysis = app_module.BackgroundAnalysis(source)
+
+        def compositor():
+            out = BytesIO()
+            app_module.render_artistic(encoded, analysis, out, 'jpeg', '#000000')
+            return out
+
+        reference = np.asarray(Image.open(to_artistic()), dtype=np.int16)
+        candidate = np.asarray(Image.open(compositor()), dtype=np.int16)
+        old_ms = timed(to_artistic, args.repeat)
+        new_ms = timed(compositor, args.repeat)
+        print(f'{width}x{height:<7} {old_ms:15.1f} {new_ms:14.1f} {old_ms / new_ms:7.1f}x {np.abs(reference - candidate).max():9d}')
+
+
+def synthetic_animations(seed=0):
+    """Yields (name, frames): a sprite moving over a still photo with held frames, a pan across a
+    noisy background where every frame changes, and a sprite whose held frames differ slightly."""
+    background = synthetic_background(480, 360, seed)
+    frames = []
+    for index in range(48):
+        frame = background.copy()
+        # The sprite holds still for every other pair of frames, like a typical banner animation
+        x = 40 + (index // 2) * 12
+        frame.paste((220, 40, 40), (x, 150, x + 48, 198))
+        frames.append(frame)
+    yield 'sprite', frames
+
+    wide = synthetic_background(960, 360, seed)
+    yield 'pan', [wide.crop((index * 10, 0, index * 10 + 480, 360)) for index in range(48)]
+
+    # Held frames that differ in one pixel, so PIL keeps them and the writer has to merge them
+    frames = []
+    for index in range(48):
+        frame = background.copy()
+        x = 40 + (index // 4) * 24
+        frame.paste((40, 40, 220), (x, 150, x + 48, 198))
+        frame.putpixel((index % 4, 0), (index * 5 % 256, 0, 0))
+        frames.append(frame)
+    yield 'held', frames
+
+
+def legacy_gif(layout, analysis, out):
+    """The GIF writer before the shared palette: every frame converted to the web palette and
+    written whole, with its own color table."""
+    for index, (frame, duration) in enumerate(zip(analysis.iter_frames(), analysis.durations)):
+        frame = layout.composite(frame, '#000000').convert('P')
+        if not index:
+            header, _ = app_module.GifImagePlugin.getheader(frame, info={'loop': 0, 'duration': duration})
+            for chunk in header:
+                out.write(chunk)
+        for chunk in app_module.GifImagePlugin.getdata(frame, duration=duration, include_color_table=True):
+            out.write(chunk)
+    out.write(b';')
+
+
+def bench_animated(args):
+    """Encode time and size of animated output: the old per-frame GIF writer against the shared
+    palette GIF writer, animated WebP and APNG. Uses --gif files if given, synthetic animations otherwise.
+
+    Returns 1 if the GIF writer's output is larger than the legacy writer's for any animation.
+    """
+    if args.gif:
+        animations = []
+        for path in args.gif:
+            with open(path, 'rb') as gif_file:
+                animations.append((os.path.basename(path), gif_file.read()))
+    else:
+        animations = []
+        for name, frames in synthetic_animations():
+            encoded = BytesIO()
+            frames[0].save(encoded, format='GIF', save_all=True, append_images=frames[1:], duration=80, loop=0)
+            animations.append((name, encoded.getvalue()))
+
+    encoded_qr = app_module.matrix_cache.encode(PAYLOAD)
+    layout = app_module.ArtisticLayout(encoded_qr)
+    print(f'{"animation":>14} {"frames":>6} {"writer":>10} {"ms":>8} {"KB":>8} {"vs legacy":>9} {"frames out":>10}')
+    larger = 0
+    for name, data in animations:
+        analysis = app_module.analyse_background(BytesIO(data), PAYLOAD)
+        writers = {'legacy gif': lambda out: legacy_gif(layout, analysis, out)}
+        for label, kind in (('gif', 'gif'), ('webp', 'webp'), ('apng', 'png')):
+            writers[label] = lambda out, kind=kind: app_module.render_artistic(encoded_qr, analysis, out, kind, '#000000', layout=layout)
+        sizes = {}
+        for label, write in writers.items():
+            out = BytesIO()
+            write(out)
+            sizes[label] = len(out.getvalue())
+            frames_out = getattr(Image.open(BytesIO(out.getvalue())), 'n_frames', 1)
+            ms = timed(lambda: write(BytesIO()), args.repeat)
+            change = sizes[label] / sizes['legacy gif'] - 1
+            print(f'{name[:14]:>14} {analysis.frame_count:6d} {label:>10} {ms:8.1f} {sizes[label] / 1024:8.1f} '
+                  f'{change:+8.1%} {frames_out:10d}')
+        if sizes['gif'] > sizes['legacy gif']:
+            larger += 1
+            print(f'  {name}: the GIF writer is larger than the legacy one')
+    return 1 if larger else 0
+
+
+def analysis_corpus(seed=0):
+    """Yields (name, encoded bytes) for backgrounds spanning dark/light and flat/contrasty."""
+    rng = np.random.default_rng(seed)
+    for index in range(24):
+        mean = rng.uniform(20, 235)
+        spread = rng.uniform(2, 90)
+        width, height = rng.integers(200, 1600, size=2)
+        pixels = rng.normal(mean, spread, (height, width, 3)) + np.linspace(-spread, spread, width)[None, :, None]
+        image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), 'RGB')
+        for kind in ('JPEG', 'PNG'):
+            encoded = BytesIO()
+            image.save(encoded, format=kind)
+            yield f'{index:02d}-{width}x{height}.{kind.lower()}', encoded.getvalue()
+        if index % 4 == 0:
+            frames = [image.resize((width // 4, height // 4)).rotate(angle) for angle in range(0, 360, 30)]
+            encoded = BytesIO()
+            frames[0].save(encoded, format='GIF', save_all=True, append_images=frames[1:], duration=50)
+            yield f'{index:02d}-{width // 4}x{height // 4}.gif', encoded.getvalue()
+
+
+def legacy_decisions(data):
+    """The per-helper decode and statistics code that used to live in code.py."""
+    image = Image.open(BytesIO(data))
+    if image.format == 'GIF':
+        frames = [frame.convert('L') for frame in ImageSequence.Iterator(image)]
+        dark = sum(ImageStat.Stat(frame).mean[0] for frame in frames) / len(frames) < 128
+        luminance = np.concatenate([np.array(frame).flatten() for frame in frames])
+        image = Image.open(BytesIO(data))
+        rgb = np.concatenate([np.array(frame.convert('RGB')).reshape(-1, 3) for frame in ImageSequence.Iterator(image)])
+    else:
+        dark = ImageStat.Stat(image.convert('L')).mean[0] < 128
+        luminance = np.array(image.convert('L')).flatten()
+        rgb = np.array(image.convert('RGB')).reshape(-1, 3)
+    high_contrast = np.percentile(luminance, 95) - np.percentile(luminance, 5) > 100
+    opposite = tuple(max(0, min(100, int(c))) for c in 255 - np.mean(rgb, axis=0))
+    return dark, high_contrast, '#%02x%02x%02x' % opposite
+
+
+def bench_analysis(args):
+    """Checks the histogram statistics against the legacy helpers and times each sample size.
+
+    Returns 1 if any decision at full resolution differs from the legacy helpers, so the check can gate changes.
+    """
+    corpus = list(analysis_corpus())
+    legacy_ms = timed(lambda: [legacy_decisions(data) for _, data in corpus], args.repeat)
+    expected = [legacy_decisions(data) for _, data in corpus]
+    print(f'{len(corpus)} backgrounds, legacy helpers: {legacy_ms:.0f} ms')
+    print(f'{"sample size":>12} {"ms":>8} {"speedup":>8} {"same decisions":>15}')
+    mismatches = 0
+    for sample_size in (0, 1024, 512, 256, 128):
+        def analyse():
+            results = []
+            for _, data in corpus:
+                analysis = app_module.BackgroundAnalysis(BytesIO(data), sample_size=sample_size)
+                results.append((app_module.is_image_dark(analysis), app_module.is_image_high_contrast(analysis),
+                                app_module.get_opposite_dark_color(analysis)))
+            return results
+
+        results = analyse()
+        same = sum(result == reference for result, reference in zip(results, expected))
+        elapsed = timed(analyse, args.repeat)
+        print(f'{sample_size or "full":>12} {elapsed:8.0f} {legacy_ms / elapsed:7.1f}x {same:>9}/{len(corpus)}')
+        if sample_size == 0:
+            for (name, _), result, reference in zip(corpus, results, expected):
+                if result != reference:
+                    mismatches += 1
+                    print(f'  mismatch on {name}: {result} != {reference}')
+    if mismatches:
+        print(f'{mismatches} full resolution mismatch(es) with the legacy helpers')
+        return 1
+    return 0
+
+
+def adversarial_backgrounds(data):
+    """Yields (name, encoded PNG) for backgrounds drawn against the module pattern of data's QR code.
+
+    Only the center third of each module keeps the QR color, so a scanner that blurs it into its
+    cell mostly reads the background: the inverse of the pattern, or a checkerboard or stripes
+    of module-sized cells.
+    """
+    layout = app_module.ArtisticLayout(app_module.matrix_cache.encode(data))
+    rows, columns = np.indices(layout.dark_modules.shape)
+    patterns = {
+        'inverse': layout.dark_modules,
+        'checker': (rows + columns) % 2 == 1,
+        'stripes': columns % 2 == 1,
+    }
+    for name, light in patterns.items():
+        cells = np.kron(np.where(light, 255, 0), np.ones((layout.scale, layout.scale))).astype(np.uint8)
+        encoded = BytesIO()
+        Image.fromarray(cells).convert('RGB').save(encoded, format='PNG')
+        yield name, encoded.getvalue()
+
+
+def camera_decode(image_io):
+    """Decodes the first frame the way a phone camera might see it: about 6 pixels per module, slightly blurred."""
+    from pyzbar.pyzbar import decode
+
+    image = Image.open(image_io)
+    gray = image.convert('L').reduce(2).filter(ImageFilter.GaussianBlur(1.0))
+    return bool(decode(gray))
+
+
+def bench_scannability(args):
+    """Compares score_scannability with a blurred pyzbar decode and times the check.
+
+    Every background of the analysis corpus is rendered in a few colors; backgrounds drawn against
+    the module pattern must never pass. Returns 1 if any of them does, so the check can gate changes.
+    """
+    colors = ('#000000', '#777777', '#ffffff')
+    counts = {(passed, decoded): 0 for passed in (True, False) for decoded in (True, False)}
+    tie_breaks = 0
+    scoring = []
+    for name, background in analysis_corpus():
+        for color in colors:
+            analysis = app_module.analyse_background(BytesIO(background), PAYLOAD)
+            kind = os.path.splitext(name)[1][1:]
+            start = time.perf_counter()
+            image_io, score = app_module.render_qr(PAYLOAD, color, analysis, kind, check_scannable=True)
+            scoring.append(time.perf_counter() - start)
+            counts[(score.passed, camera_decode(image_io))] += 1
+            tie_breaks += score.decoded is not None
+    total = sum(counts.values())
+    print(f'{total} renders: {counts[True, True] + counts[False, False]} agree with the blurred decode, '
+          f'{counts[True, False]} pass but do not decode, {counts[False, True]} fail but decode; '
+          f'{tie_breaks} needed pyzbar, render with check p50 {np.median(scoring) * 1000:.1f} ms')
+
+    passed = 0
+    for name, background in adversarial_backgrounds(PAYLOAD):
+        analysis = app_module.analyse_background(BytesIO(background), PAYLOAD)
+        image_io, score = app_module.render_qr(PAYLOAD, '#000000', analysis, 'png', check_scannable=True)
+        print(f'{name:>12}: quality {score.quality:.3f}, codeword error rate {score.codeword_error_rate:.3f}, '
+              f'{"passes" if score.passed else "fails"}, blurred decode {"reads" if camera_decode(image_io) else "fails"}')
+        passed += score.passed
+    if passed:
+        print(f'{passed} background(s) drawn against the pattern pass the scannability check')
+        return 1
+    return 0
+
+
+DEV_SERVER = '''
+import importlib.util, sys
+spec = importlib.util.spec_from_file_location('qr_app', sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+module.app.run(port=int(sys.argv[2]), debug=True, use_reloader=False)
+'''
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def multipart(fields, files):
+    """Encodes a multipart/form-data body, returning (body, content type)."""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, content) in files.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode() + content + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def wait_for_server(url, process, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'server exited with {process.returncode}')
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'server did not come up at {url}')
+
+
+def load_test(url, requests, concurrency):
+    """Sends the requests from concurrency threads; returns (wall seconds, latencies, failures)."""
+    def send(request):
+        fields, files = request
+        body, content_type = multipart(fields, files)
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url, body, {'Content-Type': content_type}), timeout=300) as response:
+                response.read()
+            return time.perf_counter() - start, True
+        except OSError:
+            return time.perf_counter() - start, False
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(send, requests))
+    return time.perf_counter() - start, [latency for latency, _ in results], sum(not ok for _, ok in results)
+
+
+def serving_requests(count):
+    """A mix of plain codes, static backgrounds and a small animated background.
+
+    Every request carries different data so that none of them is answered from the render cache.
+    """
+    photo = BytesIO()
+    synthetic_background(1024, 768).save(photo, format='JPEG', quality=90)
+    frames = [synthetic_background(200, 200, seed) for seed in range(8)]
+    animation = BytesIO()
+    frames[0].save(animation, format='GIF', save_all=True, append_images=frames[1:], duration=80)
+    backgrounds = [None, None, ('photo.jpg', photo.getvalue()), None, ('animation.gif', animation.getvalue())]
+    requests = []
+    for index in range(count):
+        fields = {'data': f'{PAYLOAD}&n={index}-{uuid.uuid4().hex[:8]}', 'color': '#000000', 'check_scannable': 'true'}
+        background = backgrounds[index % len(backgrounds)]
+        requests.append((fields, {'file': background} if background else {}))
+    return requests
+
+
+def bench_serving(args):
+    """Load-tests the development server against `code.py serve` with the same request mix."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'code.py')
+    servers = {
+        'dev server': lambda port: [sys.executable, '-c', DEV_SERVER, script, str(port)],
+        f'serve -w{args.workers} -t{args.threads}': lambda port: [
+            sys.executable, script, 'serve', '--bind', f'127.0.0.1:{port}',
+            '--workers', str(args.workers), '--threads', str(args.threads)],
+    }
+    print(f'{args.requests} requests, {args.concurrency} concurrent')
+    print(f'{"server":>18} {"req/s":>7} {"p50 ms":>8} {"p95 ms":>8} {"max ms":>8} {"failed":>7}')
+    for name, command in servers.items():
+        port = free_port()
+        process = subprocess.Popen(command(port), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_server(f'http://127.0.0.1:{port}/', process)
+            url = f'http://127.0.0.1:{port}/generate'
+            load_test(url, serving_requests(args.concurrency), args.concurrency)  # warm the workers up
+            elapsed, latencies, failed = load_test(url, serving_requests(args.requests), args.concurrency)
+        finally:
+            process.terminate()
+            process.wait()
+        p50, p95, worst = np.percentile(latencies, [50, 95, 100]) * 1000
+        print(f'{name:>18} {len(latencies) / elapsed:7.1f} {p50:8.0f} {p95:8.0f} {worst:8.0f} {failed:7d}')
+
+
+STARTUP = '''
+import importlib.util, json, sys, time
+start = time.perf_counter()
+for name in sys.argv[2:]:
+    __import__(name)
+spec = importlib.util.spec_from_file_location('qr_app', sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+loaded = time.perf_counter() - start
+
+def rss_mb():
+    with open('/proc/self/status') as status:
+        return int(status.read().split('VmRSS:')[1].split()[0]) / 1024
+
+import_rss = rss_mb()
+assert module.app.test_client().post('/generate', data={'data': 'startup'}).status_code == 200
+print(json.dumps({'import_ms': loaded * 1000, 'import_rss': import_rss, 'plain_rss': rss_mb(),
+                  'heavy': sorted(name for name in ('numpy', 'PIL.Image', 'pyzbar.pyzbar') if name in sys.modules)}))
+'''
+
+STARTUP_MODULES = ('flask', 'segno', 'numpy', 'PIL.Image', 'pyzbar.pyzbar')
+
+
+def bench_startup(args):
+    """Cold start of code.py in a fresh interpreter: import time, RSS, and what a plain request loads.
+
+    'eager' imports numpy, PIL and pyzbar up front, the way code.py used to.
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'code.py')
+    profiles = {
+        'eager': (['numpy', 'PIL.Image', 'PIL.ImageOps', 'PIL.GifImagePlugin', 'pyzbar.pyzbar'], {}),
+        'lazy': ([], {}),
+        'plain only': ([], {'QR_PLAIN_ONLY': '1'}),
+    }
+    print(f'{"profile":>10} {"import ms":>10} {"import RSS MB":>14} {"after plain MB":>15}  heavy modules loaded')
+    for name, (preload, env) in profiles.items():
+        env = {**os.environ, **env}
+        runs = [json.loads(subprocess.run([sys.executable, '-c', STARTUP, script, *preload], env=env, check=True,
+                                          capture_output=True, text=True).stdout) for _ in range(args.repeat)]
+        import_ms = float(np.median([run['import_ms'] for run in runs]))
+        import_rss = float(np.median([run['import_rss'] for run in runs]))
+        plain_rss = float(np.median([run['plain_rss'] for run in runs]))
+        print(f'{name:>10} {import_ms:10.0f} {import_rss:14.1f} {plain_rss:15.1f}  {", ".join(runs[0]["heavy"]) or "none"}')
+
+    # Cumulative microseconds per module from -X importtime, for the eager profile
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', STARTUP, script, *profiles['eager'][0]],
+                            check=True, capture_output=True, text=True).stderr
+    cumulative = {}
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, total, module = (part.strip() for part in line.split('|'))
+            if module in STARTUP_MODULES:
+                cumulative[module] = int(total) / 1000
+    print('-X importtime, cumulative ms: ' + ', '.join(f'{module} {cumulative.get(module, 0):.0f}'
+                                                      for module in STARTUP_MODULES))
+
+
+def bench_plain(args):
+    """Compares segno's PNG and SVG writers with EncodedQR.write_png / write_svg for plain codes.
+
+    Both PNGs are decoded to pixels and must match exactly, and the QR payload must read back.
+    """
+    from pyzbar.pyzbar import decode
+
+    print(f'{"version":>8} {"segno png/s":>12} {"write_png/s":>12} {"speedup":>8} {"bytes":>13} {"pixels":>7} '
+          f'{"segno svg/s":>12} {"write_svg/s":>12}')
+    for length in (10, 60, 250, 900):
+        data = (PAYLOAD * 20)[:length]
+        qr = segno.make(data, error='H', boost_error=True)
+        encoded = app_module.EncodedQR(qr)
+        reference, candidate = BytesIO(), BytesIO()
+        qr.save(reference, kind='png', scale=12, border=4, dark='#1a2b3c')
+        encoded.write_png(candidate, scale=12, border=4, dark='#1a2b3c')
+        reference_pixels = np.asarray(Image.open(reference).convert('RGB'))
+        candidate_pixels = np.asarray(Image.open(candidate).convert('RGB'))
+        same = np.array_equal(reference_pixels, candidate_pixels) and bool(decode(Image.fromarray(candidate_pixels)))
+
+        segno_png = timed(lambda: qr.save(BytesIO(), kind='png', scale=12, border=4, dark='#1a2b3c'), args.repeat)
+        fast_png = timed(lambda: encoded.write_png(BytesIO(), scale=12, border=4, dark='#1a2b3c'), args.repeat)
+        segno_svg = timed(lambda: qr.save(BytesIO(), kind='svg', scale=12, border=4, dark='#1a2b3c'), args.repeat)
+        fast_svg = timed(lambda: encoded.write_svg(BytesIO(), scale=12, border=4, dark='#1a2b3c'), args.repeat)
+        sizes = f'{len(reference.getvalue())}/{len(candidate.getvalue())}'
+        print(f'{qr.version:>8} {1000 / segno_png:12.0f} {1000 / fast_png:12.0f} {segno_png / fast_png:7.1f}x {sizes:>13} '
+              f'{"same" if same else "DIFF":>7} {1000 / segno_svg:12.0f} {1000 / fast_svg:12.0f}')
+
+    data = (PAYLOAD * 20)[:250]
+    encoded = app_module.EncodedQR(segno.make(data, error='H', boost_error=True))
+    print(f'zlib level (version {encoded.version}): ' + ', '.join(
+        f'{level}: {len(write_png(encoded, level))} B {timed(lambda: write_png(encoded, level), args.repeat):.2f} ms'
+        for level in (1, 6, 9)))
+
+
+def write_png(encoded, level):
+    out = BytesIO()
+    encoded.write_png(out, scale=12, border=4, dark='#1a2b3c', compresslevel=level)
+    return out.getvalue()
+
+
+PRERESIZE = '''
+import importlib.util, json, sys, time
+from io import BytesIO
+
+def peak_rss_mb():
+    # VmHWM, unlike ru_maxrss, starts over at exec instead of inheriting the parent's peak
+    with open('/proc/self/status') as status:
+        return int(status.read().split('VmHWM:')[1].split()[0]) / 1024
+
+spec = importlib.util.spec_from_file_location('qr_app', sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+module.app.config['PRERESIZE_MULTIPLE'] = float(sys.argv[3])
+with open(sys.argv[2], 'rb') as background_file:
+    background = background_file.read()
+warm_up = BytesIO()
+module.Image.new('RGB', (64, 64)).save(warm_up, format='PNG')
+module.render_qr('warm up', analysis=module.analyse_background(warm_up, 'warm up'), check_scannable=True)
+baseline = peak_rss_mb()
+samples = []
+for _ in range(int(sys.argv[4])):
+    start = time.perf_counter()
+    analysis = module.analyse_background(BytesIO(background), sys.argv[5])
+    module.render_qr(sys.argv[5], '#000000', analysis, 'png', check_scannable=True)
+    samples.append(time.perf_counter() - start)
+samples.sort()
+print(json.dumps({'ms': samples[len(samples) // 2] * 1000, 'peak_mb': peak_rss_mb(), 'growth_mb': peak_rss_mb() - baseline,
+                  'size': analysis.size}))
+'''
+
+
+def bench_preresize(args):
+    """Times analysis plus render of 12 MP photos with and without the pre-resize stage.
+
+    Each configuration runs in a fresh interpreter so peak RSS is its own.
+    """
+    import tempfile
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'code.py')
+    photo = synthetic_background(4000, 3000, seed=3)
+    print(f'{"background":>16} {"multiple":>9} {"decoded as":>11} {"ms":>8} {"peak RSS MB":>12} {"RSS growth MB":>14}')
+    with tempfile.TemporaryDirectory() as directory:
+        for kind, extension in (('JPEG', 'jpg'), ('PNG', 'png')):
+            path = os.path.join(directory, f'photo.{extension}')
+            photo.save(path, format=kind)
+            for multiple in (0, 4, 2):
+                result = json.loads(subprocess.run(
+                    [sys.executable, '-c', PRERESIZE, script, path, str(multiple), str(args.repeat), PAYLOAD],
+                    check=True, capture_output=True, text=True).stdout)
+                decoded = '{}x{}'.format(*result['size'])
+                print(f'{"4000x3000 " + kind:>16} {multiple or "off":>9} {decoded:>11} {result["ms"]:8.0f} '
+                      f'{result["peak_mb"]:12.0f} {result["growth_mb"]:14.0f}')
+
+
+def suite_corpus(seed=0):
+    """Yields (case name, form fields, background filename and bytes or None) for the suite.
+
+    Everything is generated from fixed seeds, so every run renders the same inputs.
+    """
+    rng = np.random.default_rng(seed)
+    for length in (12, 120, 1200):
+        data = ''.join(rng.choice(list('abcdefghijklmnopqrstuvwxyz0123456789/-.?=&'), length))
+        yield f'plain-{length}', {'data': data}, None
+    for kind, extension in (('JPEG', 'jpg'), ('PNG', 'png')):
+        for label, (width, height) in (('small', (640, 480)), ('large', (3000, 2000))):
+            encoded = BytesIO()
+            synthetic_background(width, height, seed).save(encoded, format=kind)
+            yield f'{extension}-{label}', {'data': PAYLOAD, 'check_scannable': 'true'}, (f'background.{extension}', encoded.getvalue())
+    for label, (frame_count, width, height) in (('short', (8, 200, 200)), ('long', (60, 480, 360))):
+        frames = [synthetic_background(width, height, seed + index) for index in range(frame_count)]
+        encoded = BytesIO()
+        frames[0].save(encoded, format='GIF', save_all=True, append_images=frames[1:], duration=60, loop=0)
+        yield f'gif-{label}', {'data': PAYLOAD, 'check_scannable': 'true'}, ('background.gif', encoded.getvalue())
+
+
+def _status_kb(field):
+    with open('/proc/self/status') as status:
+        return int(status.read().split(f'{field}:')[1].split()[0])
+
+
+def _reset_peak_rss():
+    """Starts VmHWM over from the current RSS. Returns False where that is not supported."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def percentiles(samples):
+    samples_ms = np.array(samples) * 1000
+    return {'p50_ms': float(np.percentile(samples_ms, 50)), 'p95_ms': float(np.percentile(samples_ms, 95)),
+            'max_ms': float(samples_ms.max()), 'count': len(samples)}
+
+
+def bench_suite(args):
+    """End-to-end /generate latency, throughput and peak memory per case and per stage.
+
+    Requests go through the Flask test client with the render cache disabled. Stage times
+    come from the app's own observe_stage calls. The peak RSS of a stage is measured by
+    resetting VmHWM at the end of each stage, so it covers the time since the previous stage ended.
+    """
+    app_module.render_cache.max_bytes = 0
+    client = app_module.app.test_client()
+    track_memory = _reset_peak_rss()
+    observe_stage = app_module.observe_stage
+    stage_samples = {}
+
+    def record_stage(stage, seconds, kind, background):
+        observe_stage(stage, seconds, kind, background)
+        samples = stage_samples.setdefault(stage, {'seconds': [], 'peak_mb': []})
+        samples['seconds'].append(seconds)
+        if track_memory:
+            samples['peak_mb'].append((_status_kb('VmHWM') - case_rss) / 1024)
+            _reset_peak_rss()
+
+    app_module.observe_stage = record_stage
+    results = {'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                               'pillow': Image.__version__, 'segno': segno.__version__,
+                               'cpus': os.cpu_count(), 'iterations': args.repeat},
+               'cases': {}}
+    print(f'{"case":>12} {"p50 ms":>8} {"p95 ms":>8} {"max ms":>8} {"req/s":>7} {"peak MB":>8}  slowest stages (p50 ms)')
+    try:
+        for name, fields, background in suite_corpus():
+            def post():
+                form = dict(fields)
+                if background:
+                    form['file'] = (BytesIO(background[1]), background[0])
+                response = client.post('/generate', data=form, content_type='multipart/form-data')
+                response.close()
+                if response.status_code != 200:
+                    raise RuntimeError(f'{name}: HTTP {response.status_code} {response.data[:200]!r}')
+
+            case_rss = _status_kb('VmRSS')
+            post()  # warm up caches and lazy imports outside the measurement
+            stage_samples.clear()
+            case_rss = _status_kb('VmRSS')
+            _reset_peak_rss()
+            latencies = []
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                request_start = time.perf_counter()
+                post()
+                latencies.append(time.perf_counter() - request_start)
+            elapsed = time.perf_counter() - start
+            peak_mb = max((max(samples['peak_mb']) for samples in stage_samples.values() if samples['peak_mb']), default=None)
+
+            case = {**percentiles(latencies), 'throughput_rps': args.repeat / elapsed, 'peak_mb': peak_mb,
+                    'stages': {stage: {**percentiles(samples['seconds']),
+                                       'peak_mb': max(samples['peak_mb']) if samples['peak_mb'] else None}
+                               for stage, samples in stage_samples.items()}}
+            results['cases'][name] = case
+            slowest = sorted(case['stages'].items(), key=lambda item: -item[1]['p50_ms'])[:3]
+            print(f'{name:>12} {case["p50_ms"]:8.1f} {case["p95_ms"]:8.1f} {case["max_ms"]:8.1f} '
+                  f'{case["throughput_rps"]:7.1f} {peak_mb if peak_mb is not None else float("nan"):8.1f}  '
+                  + ', '.join(f'{stage} {stats["p50_ms"]:.1f}' for stage, stats in slowest))
+    finally:
+        app_module.observe_stage = observe_stage
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+    if args.baseline:
+        return check_regressions(results, args.baseline, args.threshold)
+
+
+def check_regressions(results, baseline_path, threshold):
+    """Compares p50 latency per case with a saved run; returns 1 if any case got slower than threshold allows."""
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    regressions = 0
+    for name, case in results['cases'].items():
+        previous = baseline['cases'].get(name)
+        if previous is None:
+            continue
+        change = case['p50_ms'] / previous['p50_ms'] - 1
+        if change > threshold:
+            regressions += 1
+            print(f'REGRESSION {name}: p50 {previous["p50_ms"]:.1f} ms -> {case["p50_ms"]:.1f} ms ({change:+.0%})')
+    print(f'{regressions} regression(s) over {threshold:.0%} against {baseline_path}')
+    return 1 if regressions else 0
+
+
+BENCHMARKS = {
+    'analysis': bench_analysis,
+    'animated': bench_animated,
+    'compositor': bench_compositor,
+    'plain': bench_plain,
+    'preresize': bench_preresize,
+    'scannability': bench_scannability,
+    'serving': bench_serving,
+    'startup': bench_startup,
+    'suite': bench_suite,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('name', choices=sorted(BENCHMARKS), help='benchmark to run')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per measurement (median is reported)')
+    parser.add_argument('--requests', type=int, default=200, help='serving: requests per server')
+    parser.add_argument('--concurrency', type=int, default=8, help='serving: concurrent clients')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='serving: gunicorn workers')
+    parser.add_argument('--threads', type=int, default=4, help='serving: threads per gunicorn worker')
+    parser.add_argument('--gif', action='append', help='animated: a GIF to benchmark, may be repeated')
+    parser.add_argument('--json', help='suite: write the results to this file')
+    parser.add_argument('--baseline', help='suite: results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='suite: fail if a case\'s p50 latency grew by more than this fraction (default 0.2)')
+    args = parser.parse_args(argv)
+    return BENCHMARKS[args.name](args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,20 +1,146 @@
-from flask import Flask, request, send_file, render_template_string
+from flask import Flask, Request, Response, g, has_request_context, request, send_file, render_template_string, jsonify, url_for
 import segno
+from segno import consts, encoder as segno_encoder, utils as segno_utils
+import math
 import os
 import shutil
+import argparse
+import colorsys
+import contextlib
+import cProfile
+import csv
+import functools
+import gc
+import gzip
+import hashlib
+import importlib
+import io
+import itertools
+import json
+import marshal
+import mmap
+import multiprocessing
+import pickle
+import pstats
+import random
+import re
+import signal
+import struct
+import sys
+import tarfile
+import tempfile
+import threading
+import uuid
+import zipfile
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import ClosingIterator
 from io import BytesIO
-import tempfile
-import numpy as np
-from PIL import Image, ImageStat, ImageOps, ImageSequence
+import time
+
+try:
+    import brotli
+except ImportError:  # optional, the index page is then sent gzip-compressed
+    brotli = None
+
+class LazyModule:
+    """Stands in for a module until an attribute is first used, then imports it and
+    replaces itself with the real module in this file's globals.
 
-import cv2
-from pyzbar.pyzbar import decode
+    numpy, PIL and pyzbar are only needed for backgrounds, so plain QR codes never load them.
+    """
+
+    def __init__(self, name, alias):
+        self._name = name
+        self._alias = alias
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return getattr(module, attr)
+
+np = LazyModule('numpy', 'np')
+Image = LazyModule('PIL.Image', 'Image')
+ImageColor = LazyModule('PIL.ImageColor', 'ImageColor')
+ImageOps = LazyModule('PIL.ImageOps', 'ImageOps')
+ImageSequence = LazyModule('PIL.ImageSequence', 'ImageSequence')
+GifImagePlugin = LazyModule('PIL.GifImagePlugin', 'GifImagePlugin')
+pyzbar = LazyModule('pyzbar.pyzbar', 'pyzbar')
 
 app = Flask(__name__)
-UPLOAD_FOLDER = '/tmp/uploads'
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+# Whole request bodies over this are refused before they are read
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('QR_MAX_CONTENT_LENGTH', 32 * 1024 * 1024))
+# Background uploads: bytes, pixels per frame and frames. JPEGs over the pixel limit are
+# decoded at a reduced scale instead of being refused, if 1/8 scale is enough
+app.config['MAX_UPLOAD_BYTES'] = int(os.environ.get('QR_MAX_UPLOAD_BYTES', 20 * 1024 * 1024))
+app.config['MAX_IMAGE_PIXELS'] = int(os.environ.get('QR_MAX_IMAGE_PIXELS', 40 * 1000 * 1000))
+app.config['MAX_FRAMES'] = int(os.environ.get('QR_MAX_FRAMES', 1000))
+# Backgrounds are shrunk right after decoding to this multiple of the QR symbol width (0 = full size)
+app.config['PRERESIZE_MULTIPLE'] = float(os.environ.get('QR_PRERESIZE_MULTIPLE', 2))
+app.config['RENDER_CACHE_MAX_BYTES'] = int(os.environ.get('QR_RENDER_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+app.config['RENDER_CACHE_DIR'] = os.environ.get('QR_RENDER_CACHE_DIR')
+# The on-disk tier is pruned, least recently used first, to stay under this many bytes (0 = unbounded)
+app.config['RENDER_CACHE_DISK_MAX_BYTES'] = int(os.environ.get('QR_RENDER_CACHE_DISK_MAX_BYTES', 1024 * 1024 * 1024))
+# Encoded module matrices of recent payloads, bit-packed
+app.config['MATRIX_CACHE_MAX_BYTES'] = int(os.environ.get('QR_MATRIX_CACHE_MAX_BYTES', 4 * 1024 * 1024))
+# zlib level for plain PNG codes, 1 (fastest) to 9 (smallest)
+app.config['PNG_COMPRESS_LEVEL'] = int(os.environ.get('QR_PNG_COMPRESS_LEVEL', 6))
+# GIFs with more pixels than this (width * height * frames) are streamed frame by frame
+app.config['GIF_STREAM_MIN_PIXELS'] = int(os.environ.get('QR_GIF_STREAM_MIN_PIXELS', 32 * 1024 * 1024))
+# Consecutive animation frames with at most this fraction of their pixels changed are merged into one longer frame
+app.config['ANIMATION_MERGE_THRESHOLD'] = float(os.environ.get('QR_ANIMATION_MERGE_THRESHOLD', 0.0005))
+app.config['ANIMATION_WEBP_QUALITY'] = int(os.environ.get('QR_ANIMATION_WEBP_QUALITY', 90))
+# Background statistics are computed on a thumbnail of at most this many pixels per side (0 = full resolution)
+app.config['ANALYSIS_SAMPLE_SIZE'] = int(os.environ.get('QR_ANALYSIS_SAMPLE_SIZE', 0))
+# Scannability checks decode at about this many pixels per module, and at most this many frames of an animation
+app.config['SCAN_MODULE_PIXELS'] = int(os.environ.get('QR_SCAN_MODULE_PIXELS', 3))
+app.config['SCAN_SAMPLE_FRAMES'] = int(os.environ.get('QR_SCAN_SAMPLE_FRAMES', 3))
+# Codeword error rates within this fraction of the error correction budget are confirmed with pyzbar
+app.config['SCAN_TIE_BAND'] = float(os.environ.get('QR_SCAN_TIE_BAND', 0.25))
+# A module also counts as misread when its whole cell is this fraction of the full range on the wrong side
+app.config['SCAN_CELL_FLOOR'] = float(os.environ.get('QR_SCAN_CELL_FLOOR', 0.2))
+app.config['COLOR_SEARCH_WORKERS'] = int(os.environ.get('QR_COLOR_SEARCH_WORKERS', 4))
+app.config['BATCH_WORKERS'] = int(os.environ.get('QR_BATCH_WORKERS', os.cpu_count() or 1))
+app.config['BATCH_MAX_ROWS'] = int(os.environ.get('QR_BATCH_MAX_ROWS', 10000))
+# Batches streamed at once; further batches are refused with 503 until one finishes
+app.config['BATCH_CONCURRENCY'] = int(os.environ.get('QR_BATCH_CONCURRENCY', 2))
+# Background render jobs: worker threads, queued + running jobs before /jobs answers 429,
+# and seconds a finished job's result is kept
+app.config['JOB_WORKERS'] = int(os.environ.get('QR_JOB_WORKERS', 2))
+app.config['JOB_QUEUE_DEPTH'] = int(os.environ.get('QR_JOB_QUEUE_DEPTH', 32))
+app.config['JOB_RESULT_TTL'] = float(os.environ.get('QR_JOB_RESULT_TTL', 600))
+# Admission control: concurrent renders per pool (plain codes, static and animated backgrounds),
+# pixels per render over all frames as decoded, and seconds a render may run before it is stopped
+app.config['ADMIT_PLAIN'] = int(os.environ.get('QR_ADMIT_PLAIN', 64))
+app.config['ADMIT_STATIC'] = int(os.environ.get('QR_ADMIT_STATIC', 2 * (os.cpu_count() or 1)))
+app.config['ADMIT_ANIMATED'] = int(os.environ.get('QR_ADMIT_ANIMATED', max(1, (os.cpu_count() or 1) // 2)))
+app.config['PIXEL_BUDGET'] = int(os.environ.get('QR_PIXEL_BUDGET', 200 * 1000 * 1000))
+app.config['GENERATE_DEADLINE'] = float(os.environ.get('QR_GENERATE_DEADLINE', 30))
+app.config['JOB_DEADLINE'] = float(os.environ.get('QR_JOB_DEADLINE', 300))
+# Registered backgrounds (POST /assets): decoded frames on disk, shared by every worker through mmap.
+# The least recently used assets are deleted once the directory holds more than ASSET_MAX_BYTES,
+# and each worker keeps at most ASSET_OPEN_MAX of them mapped.
+app.config['ASSET_DIR'] = os.environ.get('QR_ASSET_DIR', os.path.join(tempfile.gettempdir(), 'qr-assets'))
+app.config['ASSET_MAX_BYTES'] = int(os.environ.get('QR_ASSET_MAX_BYTES', 1024 * 1024 * 1024))
+app.config['ASSET_OPEN_MAX'] = int(os.environ.get('QR_ASSET_OPEN_MAX', 64))
+# Plain codes with data up to this many characters get an immutable GET URL, /qr/<key>.<ext>?data=...
+app.config['PERMALINK_MAX_DATA'] = int(os.environ.get('QR_PERMALINK_MAX_DATA', 1024))
+# Request profiling, off by default. /generate calls are profiled with cProfile when they send
+# X-QR-Profile: <PROFILE_TOKEN>, or at random with PROFILE_SAMPLE_RATE; calls slower than
+# PROFILE_SLOW_SECONDS keep stack samples taken every PROFILE_SAMPLE_INTERVAL seconds.
+# The last PROFILE_KEEP profiles are kept in PROFILE_DIR and listed at /profiles.
+app.config['PROFILE_TOKEN'] = os.environ.get('QR_PROFILE_TOKEN')
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('QR_PROFILE_SAMPLE_RATE', 0))
+app.config['PROFILE_SLOW_SECONDS'] = float(os.environ.get('QR_PROFILE_SLOW_SECONDS', 0))
+app.config['PROFILE_SAMPLE_INTERVAL'] = float(os.environ.get('QR_PROFILE_SAMPLE_INTERVAL', 0.005))
+app.config['PROFILE_KEEP'] = int(os.environ.get('QR_PROFILE_KEEP', 50))
+app.config['PROFILE_DIR'] = os.environ.get('QR_PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'qr-profiles'))
+# Plain-only workers refuse backgrounds and never import numpy, PIL or pyzbar
+app.config['PLAIN_ONLY'] = os.environ.get('QR_PLAIN_ONLY', '') not in ('', '0', 'false')
 
 HTML_TEMPLATE = '''
 <!doctype html>
@@ -371,6 +497,10 @@ HTML_TEMPLATE = '''
                             <input type="checkbox" name="contrast_qr" id="contrast_qr">
                             <label for="contrast_qr">Automatically Pick QR Color</label>
                         </div>
+                        <div class="checkbox-group">
+                            <input type="checkbox" name="auto_color" id="auto_color" checked>
+                            <label for="auto_color">Adjust Color If Hard To Scan</label>
+                        </div>
                     </div>
                     <div id="color-warning">
                         Please select a dark color for better QR code visibility!
@@ -404,6 +534,7 @@ HTML_TEMPLATE = '''
         <div class="modal-content">
             <h2 class="modal-title">⚠️ QR Code May Not Be Scannable</h2>
             <p>The QR code generated with this background may be difficult to scan. This can happen due to:</p>
+            <p id="quality-score" style="display: none;"></p>
             <ul style="text-align: left;">
                 <li>Background image is too busy or has too much contrast</li>
                 <li>QR code color doesn't stand out enough from the background</li>
@@ -430,6 +561,7 @@ HTML_TEMPLATE = '''
             const unscannableModal = document.getElementById('unscannable-modal');
             const tryAgainBtn = document.getElementById('try-again-btn');
             const downloadAnywayBtn = document.getElementById('download-anyway-btn');
+            const qualityScore = document.getElementById('quality-score');
             
             // Flag to track if we're downloading anyway
             let downloadAnyway = false;
@@ -487,6 +619,12 @@ HTML_TEMPLATE = '''
                             return response.json().then(data => {
                                 if (data.scannable === false) {
                                     // Show the modal if not scannable
+                                    if (typeof data.quality === 'number') {
+                                        qualityScore.textContent = 'Estimated scan quality: ' + Math.round(data.quality * 100) + '%';
+                                        qualityScore.style.display = 'block';
+                                    } else {
+                                        qualityScore.style.display = 'none';
+                                    }
                                     unscannableModal.style.display = 'block';
                                     // Save the blob data for potential download
                                     return response.blob().then(blob => {
@@ -614,163 +752,3006 @@ HTML_TEMPLATE = '''
 </html>
 '''
 
-def is_qr_code_scannable(image_path):
-    """Check if the generated QR code is scannable."""
+class Metrics:
+    """Counters and histograms, exposed at /metrics in the Prometheus text format.
+
+    Like the caches, these are per process: with several server workers each one reports its own.
+    """
+
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}  # name -> (type, help, {label items: value or [bucket counts, sum, count]})
+
+    def describe(self, name, metric_type, help_text):
+        self._metrics[name] = (metric_type, help_text, {})
+
+    def inc(self, name, labels=None, amount=1):
+        key = tuple(sorted((labels or {}).items()))
+        with self._lock:
+            series = self._metrics[name][2]
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, value, labels=None):
+        key = tuple(sorted((labels or {}).items()))
+        with self._lock:
+            series = self._metrics[name][2]
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+            for index, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @staticmethod
+    def _labels(items):
+        if not items:
+            return ''
+        parts = []
+        for name, value in items:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            parts.append(f'{name}="{value}"')
+        return '{' + ','.join(parts) + '}'
+
+    def render(self, extra=()):
+        """Returns the exposition text; extra is (name, type, help, {label items: value}) for values collected at scrape time."""
+        with self._lock:
+            # Copy the histogram lists too, observe() updates them in place
+            metrics = [(name, metric_type, help_text,
+                        {key: ([list(value[0]), value[1], value[2]] if metric_type == 'histogram' else value)
+                         for key, value in series.items()})
+                       for name, (metric_type, help_text, series) in self._metrics.items()]
+        lines = []
+        for name, metric_type, help_text, series in itertools.chain(metrics, extra):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for key, value in sorted(series.items()):
+                if metric_type != 'histogram':
+                    lines.append(f'{name}{self._labels(key)} {value}')
+                    continue
+                buckets, total, count = value
+                for bound, bucket_count in zip(self.BUCKETS, buckets):
+                    lines.append(f'{name}_bucket{self._labels(key + (("le", bound),))} {bucket_count}')
+                lines.append(f'{name}_bucket{self._labels(key + (("le", "+Inf"),))} {count}')
+                lines.append(f'{name}_sum{self._labels(key)} {total}')
+                lines.append(f'{name}_count{self._labels(key)} {count}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.describe('qr_http_requests_total', 'counter', "HTTP requests by endpoint, method and status.")
+metrics.describe('qr_http_request_duration_seconds', 'histogram', "Time spent in the request handler, by endpoint.")
+metrics.describe('qr_generate_duration_seconds', 'histogram',
+                 "Time spent rendering a code through /generate or a job, by output kind and background.")
+metrics.describe('qr_stage_duration_seconds', 'histogram', "Time spent in each rendering stage, by output kind and background.")
+metrics.describe('qr_unscannable_total', 'counter', "Codes delivered or reported as probably not scannable.")
+metrics.describe('qr_invert_decisions_total', 'counter', "Backgrounds analysed, by whether they were inverted.")
+metrics.describe('qr_admission_rejected_total', 'counter', "Renders refused by admission control, by pool and reason.")
+metrics.describe('qr_errors_total', 'counter', "Failed requests, jobs and batch items, by where they failed and status.")
+
+_KIND_LABELS = {'jpeg': 'jpg', 'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif'}
+
+def observe_stage(stage, seconds, kind, background):
+    """Records one stage duration; kind is the output kind or the background's format."""
+    metrics.observe('qr_stage_duration_seconds', seconds,
+                    {'stage': stage, 'kind': _KIND_LABELS.get(kind, kind), 'background': 'yes' if background else 'no'})
+    # Stage breakdown of a request being profiled, see profiled()
+    if has_request_context() and 'profile_stages' in g:
+        g.profile_stages.append((stage, seconds))
+
+class StackSampler:
+    """Samples the Python stack of registered threads from one background thread.
+
+    Requests are registered for the whole of their run and their samples are only kept if
+    they turn out slow, so a slow request is caught without knowing in advance. The thread
+    sleeps while nothing is registered.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._stacks = {}  # thread id -> {collapsed stack: samples}
+        self._lock = threading.Lock()
+        self._active = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Starts sampling the calling thread."""
+        with self._lock:
+            self._stacks[threading.get_ident()] = {}
+            self._active.set()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        """Stops sampling the calling thread and returns its samples."""
+        with self._lock:
+            stacks = self._stacks.pop(threading.get_ident(), {})
+            if not self._stacks:
+                self._active.clear()
+        return stacks
+
+    def _run(self):
+        while True:
+            self._active.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, stacks in self._stacks.items():
+                    frame = frames.get(thread_id)
+                    names = []
+                    while frame is not None:
+                        code = frame.f_code
+                        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                        frame = frame.f_back
+                    stack = ';'.join(reversed(names))
+                    stacks[stack] = stacks.get(stack, 0) + 1
+
+class ProfileStore:
+    """The last `keep` request profiles on disk, shared by all workers: a JSON summary per profile
+    next to the raw profile (a cProfile dump, or collapsed stacks for flamegraph.pl)."""
+
+    def __init__(self, directory, keep):
+        self.directory = directory
+        self.keep = keep
+
+    def save(self, summary, raw, suffix):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            base = os.path.join(self.directory, summary['id'])
+            with open(base + suffix, 'wb') as raw_file:
+                raw_file.write(raw)
+            with open(f'{base}.json.{os.getpid()}.tmp', 'w') as summary_file:
+                json.dump(summary, summary_file)
+            os.replace(f'{base}.json.{os.getpid()}.tmp', base + '.json')
+            # Ids start with the time, so the oldest sort first
+            names = sorted(name for name in os.listdir(self.directory) if name.endswith('.json'))
+            for name in names[:max(0, len(names) - self.keep)]:
+                for stale in (name, name[:-5] + '.prof', name[:-5] + '.stacks'):
+                    try:
+                        os.remove(os.path.join(self.directory, stale))
+                    except OSError:
+                        pass
+        except OSError as e:
+            print(f"Error saving request profile: {e}")
+
+    def summaries(self):
+        """Summaries of the kept profiles, newest first."""
+        try:
+            names = sorted((name for name in os.listdir(self.directory) if name.endswith('.json')), reverse=True)
+        except OSError:
+            return []
+        summaries = []
+        for name in names:
+            try:
+                with open(os.path.join(self.directory, name)) as summary_file:
+                    summaries.append(json.load(summary_file))
+            except (OSError, ValueError):
+                continue
+        return summaries
+
+    def raw_path(self, profile_id):
+        """Path of the raw profile with this id, or None."""
+        if not re.fullmatch(r'[0-9]+-[0-9a-f]+', profile_id):
+            return None
+        for suffix in ('.prof', '.stacks'):
+            path = os.path.join(self.directory, profile_id + suffix)
+            if os.path.exists(path):
+                return path
+        return None
+
+profile_store = ProfileStore(app.config['PROFILE_DIR'], app.config['PROFILE_KEEP'])
+stack_sampler = StackSampler(app.config['PROFILE_SAMPLE_INTERVAL'])
+
+def _profile_trigger():
+    """Why the current request should be profiled with cProfile: 'header', 'sampled' or None."""
+    token = app.config['PROFILE_TOKEN']
+    if token and request.headers.get('X-QR-Profile') == token:
+        return 'header'
+    rate = app.config['PROFILE_SAMPLE_RATE']
+    if rate and random.random() < rate:
+        return 'sampled'
+    return None
+
+def _top_functions(profiler, limit=25):
+    stats = pstats.Stats(profiler)
+    rows = sorted(stats.stats.items(), key=lambda item: -item[1][3])[:limit]
+    return [{'function': f'{name} ({os.path.basename(filename)}:{line})', 'calls': calls,
+             'self_ms': round(self_time * 1000, 3), 'total_ms': round(total_time * 1000, 3)}
+            for (filename, line, name), (_, calls, self_time, total_time, _) in rows]
+
+def _top_stacks(stacks, interval, limit=25):
+    leaves = {}
+    for stack, samples in stacks.items():
+        leaf = stack.rsplit(';', 1)[-1]
+        leaves[leaf] = leaves.get(leaf, 0) + samples
+    rows = sorted(leaves.items(), key=lambda item: -item[1])[:limit]
+    return [{'function': leaf, 'samples': samples, 'self_ms': round(samples * interval * 1000, 1)} for leaf, samples in rows]
+
+# Python 3.12+ allows one active cProfile per process, and it records every thread there, so
+# at most one request at a time is profiled with it
+_cprofile_lock = threading.Lock()
+
+def profiled(view):
+    """Profiles a view when asked to, by the X-QR-Profile header or by sampling, and keeps the
+    stack samples of any call slower than PROFILE_SLOW_SECONDS. Profiles go to profile_store.
+
+    With profiling switched off (the default) this costs a couple of config lookups per call.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        trigger = _profile_trigger()
+        slow_seconds = app.config['PROFILE_SLOW_SECONDS']
+        if trigger is None and not slow_seconds:
+            return view(*args, **kwargs)
+
+        g.profile_stages = []
+        profiler = None
+        if trigger is not None and _cprofile_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+        else:
+            # Another request holds cProfile, so this one gets stack samples instead
+            stack_sampler.start()
+        start = time.perf_counter()
+        status = 500
+        try:
+            if profiler is not None:
+                try:
+                    profiler.enable()
+                except Exception as e:
+                    # A debugger or coverage tool may hold the interpreter's profiling hook
+                    print(f"Error starting request profile: {e}")
+                    profiler = None
+                    _cprofile_lock.release()
+                    stack_sampler.start()
+            response = app.make_response(view(*args, **kwargs))
+            status = response.status_code
+            return response
+        finally:
+            elapsed = time.perf_counter() - start
+            stacks = None
+            if profiler is not None:
+                profiler.disable()
+                _cprofile_lock.release()
+            else:
+                stacks = stack_sampler.stop()
+            if trigger is None and elapsed > slow_seconds:
+                trigger = 'slow'
+            if trigger is not None:
+                try:
+                    _save_profile(trigger, status, elapsed, profiler, stacks)
+                except Exception as e:
+                    print(f"Error saving request profile: {e}")
+    return wrapper
+
+def _save_profile(trigger, status, elapsed, profiler, stacks):
+    summary = {
+        'id': f'{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}',
+        'time': time.time(),
+        'trigger': trigger,
+        'endpoint': request.endpoint,
+        'status': status,
+        'duration_ms': round(elapsed * 1000, 1),
+        'stages': [{'stage': stage, 'ms': round(seconds * 1000, 2)} for stage, seconds in g.profile_stages],
+    }
+    if profiler is not None:
+        summary['kind'] = 'cprofile'
+        summary['top'] = _top_functions(profiler)
+        raw = BytesIO()
+        marshal.dump(pstats.Stats(profiler).stats, raw)
+        profile_store.save(summary, raw.getvalue(), '.prof')
+    else:
+        summary['kind'] = 'stacks'
+        summary['top'] = _top_stacks(stacks, stack_sampler.interval)
+        lines = ''.join(f'{stack} {samples}\n' for stack, samples in sorted(stacks.items()))
+        profile_store.save(summary, lines.encode('utf-8'), '.stacks')
+
+
+def sample_frame_indices(frame_count, samples):
+    """Evenly spaced frame indices, always starting with the first frame."""
+    if samples <= 0 or frame_count <= samples:
+        return list(range(frame_count))
+    return sorted({round(i * (frame_count - 1) / max(1, samples - 1)) for i in range(samples)})
+
+def verify_scannable(images, scale=12):
+    """Check if the rendered QR code images are scannable, stopping at the first one that decodes.
+
+    Every image is converted to grayscale once and first decoded at a reduced size where a
+    module is about SCAN_MODULE_PIXELS wide; with scale=12 that is a quarter of the pixels
+    in each direction. The full resolution grayscale image is only tried if that fails.
+    """
+    factor = max(1, scale // max(1, app.config['SCAN_MODULE_PIXELS']))
     try:
-        image = cv2.imread(image_path)
-        qr_codes = decode(image)
-        return len(qr_codes) > 0
+        for image in images:
+            gray = image.convert("L")
+            if factor > 1 and pyzbar.decode(gray.reduce(factor)):
+                return True
+            if pyzbar.decode(gray):
+                return True
+        return False
     except Exception as e:
         print(f"Error checking QR code scannability: {e}")
         return False
 
-def get_opposite_dark_color(image_path):
-    """Returns a high-contrast dark color based on the majority color of the image."""
-    image = Image.open(image_path)
-    if image.format == "GIF":
-        frames = [frame.convert("RGB") for frame in ImageSequence.Iterator(image)]
-        all_pixels = np.concatenate([np.array(frame).reshape(-1, 3) for frame in frames], axis=0)
-    else:
-        image = image.convert("RGB")
-        all_pixels = np.array(image).reshape(-1, 3)
+# Share of damaged codewords in a block each error correction level can restore
+_ERROR_BUDGET = {'L': 0.07, 'M': 0.15, 'Q': 0.25, 'H': 0.30}
+
+class ScanScore:
+    """How well the rendered modules match the intended QR matrix.
+
+    codeword_error_rate is the share of damaged codewords in the worst Reed-Solomon block.
+    quality is 1.0 for a perfect read and 0.0 once that rate uses up the error correction
+    budget. decoded is None unless pyzbar was asked to break a tie.
+    """
+
+    def __init__(self, codeword_error_rate, function_error_rate, budget, passed, decoded=None):
+        self.codeword_error_rate = codeword_error_rate
+        self.function_error_rate = function_error_rate
+        self.budget = budget
+        self.passed = passed
+        self.decoded = decoded
+
+    @property
+    def quality(self):
+        return max(0.0, 1.0 - self.codeword_error_rate / self.budget)
+
+    def as_dict(self):
+        return {
+            'scannable': self.passed,
+            'quality': round(self.quality, 3),
+            'codeword_error_rate': round(self.codeword_error_rate, 4),
+        }
 
-    avg_color = np.mean(all_pixels, axis=0)
-    opposite_color = 255 - avg_color
+def score_scannability(layout, images):
+    """Scores rendered frames by sampling every module and comparing it with the QR matrix.
+
+    Each module is read as its center third (always drawn in the QR color) blurred evenly with
+    the rest of its cell, and binarized at the midpoint between the modules meant to be dark and
+    those meant to be light. A module whose cell as a whole is over SCAN_CELL_FLOOR of the full
+    range on the wrong side of that midpoint is misread too: a camera blurs the center into the
+    background, so a background drawn against the pattern defeats it. A codeword is damaged if
+    any of its eight modules is wrong, and error correction works per block, so the worst block
+    of the worst frame counts. pyzbar only runs when that codeword error rate lands within
+    SCAN_TIE_BAND of the correction budget.
+    """
+    size, scale, offset = layout.size, layout.scale, layout.offset
+    center = slice(scale // 3, scale - scale // 3)
+    expected = layout.dark_modules
+    codewords, blocks, block_sizes = codeword_blocks(layout.version, layout.error)
+    placed = codewords >= 0
+    cell_floor = app.config['SCAN_CELL_FLOOR'] * 255
+    codeword_error_rate = function_error_rate = 0.0
+    for image in images:
+        gray = np.asarray(image.convert("L"), dtype=np.float32)
+        cells = gray[offset:offset + size * scale, offset:offset + size * scale].reshape(size, scale, size, scale)
+        means = cells.mean(axis=(1, 3))
+        samples = (cells[:, center, :, center].mean(axis=(1, 3)) + means) / 2
+        threshold = (samples[expected].mean() + samples[~expected].mean()) / 2
+        errors = (samples < threshold) != expected
+        errors |= np.where(expected, means - threshold, threshold - means) > cell_floor
+        damaged = np.bincount(codewords[placed & errors], minlength=len(blocks)) > 0
+        block_errors = np.bincount(blocks[damaged], minlength=len(block_sizes))
+        codeword_error_rate = max(codeword_error_rate, float((block_errors / block_sizes).max()))
+        function_error_rate = max(function_error_rate, float(errors[layout.keep_modules].mean()))
+
+    budget = _ERROR_BUDGET[layout.error]
+    band = app.config['SCAN_TIE_BAND']
+    # Finder, timing and alignment patterns have no error correction of their own
+    if function_error_rate > 0.1 or codeword_error_rate >= budget * (1 + band):
+        return ScanScore(codeword_error_rate, function_error_rate, budget, False)
+    if codeword_error_rate <= budget * (1 - band):
+        return ScanScore(codeword_error_rate, function_error_rate, budget, True)
+    decoded = verify_scannable(images, scale=scale)
+    return ScanScore(codeword_error_rate, function_error_rate, budget, decoded, decoded=decoded)
+
+def score_encoded_image(image_io, data):
+    """Scores an encoded artistic QR code for data like render_qr does, sampling frames of animations.
+
+    Returns a ScanScore, or None if the image cannot be read.
+    """
+    try:
+        image_io.seek(0)
+        image = Image.open(image_io)
+        images = []
+        for index in sample_frame_indices(getattr(image, 'n_frames', 1), app.config['SCAN_SAMPLE_FRAMES']):
+            image.seek(index)
+            images.append(image.convert("RGB"))
+        image_io.seek(0)
+        return score_scannability(ArtisticLayout(matrix_cache.encode(data)), images)
+    except Exception as e:
+        print(f"Error checking QR code scannability: {e}")
+        return None
+
+class HistogramStats:
+    """Brightness, contrast and average color statistics accumulated as 256-bin histograms.
+
+    Pixels are 8-bit, so the luminance histogram and the per-channel RGB histograms carry
+    everything the heuristics need. Frames, tiles or whole images can be added one at a
+    time or merged, and percentiles match np.percentile on the underlying pixels exactly.
+    """
+
+    def __init__(self, sample_size=0):
+        # sample_size > 0 trades accuracy for speed: frames are subsampled to fit in a
+        # sample_size x sample_size box before they are counted.
+        self.sample_size = sample_size
+        self.luminance = np.zeros(256, dtype=np.int64)
+        self.rgb = np.zeros((3, 256), dtype=np.int64)
+
+    def add(self, frame):
+        """Counts the pixels of an RGB frame."""
+        if self.sample_size and max(frame.size) > self.sample_size:
+            # Nearest-neighbour sampling keeps the pixel distribution, a smoothing filter would
+            # pull the percentiles together and understate contrast
+            ratio = self.sample_size / max(frame.size)
+            frame = frame.resize((max(1, int(frame.width * ratio)), max(1, int(frame.height * ratio))), Image.NEAREST)
+        self.rgb += np.array(frame.histogram(), dtype=np.int64).reshape(3, 256)
+        # PIL's own "L" conversion, the same one the helpers used before the histograms
+        self.luminance += frame.convert("L").histogram()
+
+    def merge(self, other):
+        self.luminance += other.luminance
+        self.rgb += other.rgb
+
+    @property
+    def pixel_count(self):
+        return int(self.luminance.sum())
+
+    @property
+    def mean_rgb(self):
+        return self.rgb @ np.arange(256) / self.pixel_count
+
+    @property
+    def luminance_mean(self):
+        return float(self.luminance @ np.arange(256) / self.pixel_count)
+
+    def luminance_percentile(self, q):
+        """Same result as np.percentile(pixels, q) with the default linear interpolation."""
+        cumulative = np.cumsum(self.luminance)
+        rank = q / 100 * (cumulative[-1] - 1)
+        lower = int(np.searchsorted(cumulative, math.floor(rank), side='right'))
+        upper = int(np.searchsorted(cumulative, math.ceil(rank), side='right'))
+        fraction = rank - math.floor(rank)
+        if fraction >= 0.5:
+            return upper - (upper - lower) * (1 - fraction)
+        return lower + (upper - lower) * fraction
+
+class BackgroundAnalysis:
+    """Decodes an uploaded background once and computes the statistics the helpers below need.
+
+    Large animated GIFs are not kept in memory: their statistics are gathered frame by frame
+    and iter_frames() decodes the frames again, one at a time, when the code is rendered.
+
+    With a target_size (the width of the QR symbol the background will fill), frames are
+    brought down to roughly PRERESIZE_MULTIPLE times that: JPEGs are decoded at a reduced DCT
+    scale with draft() and every frame is then shrunk with reduce(), so the statistics,
+    inversion and compositing all work on the small version.
+    """
+
+    def __init__(self, source, stream_min_pixels=None, sample_size=None, target_size=None):
+        self.timings = {}
+        self.decode_count = 0
+        self.inverted = False
+
+        start = time.perf_counter()
+        image = Image.open(source)
+        self.source_size = image.size
+        max_side = target_size * app.config['PRERESIZE_MULTIPLE'] if target_size else 0
+        if image.format == 'JPEG':
+            # Oversized photos are always decoded at a reduced scale, read_upload counted them as downscaled
+            scale = jpeg_draft_scale(image.width, image.height, app.config['MAX_IMAGE_PIXELS']) or 8
+            draft_size = (math.ceil(image.width / scale), math.ceil(image.height / scale))
+            if max_side and max(draft_size) > max_side:
+                ratio = max_side / max(image.size)
+                draft_size = (math.ceil(image.width * ratio), math.ceil(image.height * ratio))
+            if draft_size != image.size:
+                image.draft('RGB', draft_size)
+        self.reduce_factor = max(1, round(max(image.size) / max_side)) if max_side else 1
+        self.size = image.size
+        self.format = image.format
+        self.mode = image.mode
+        self.info = dict(image.info)
+        self.loop = image.info.get('loop', 0)
+        self.alpha = None
+        self.frames = None
+        self.durations = None
+        self._source = source
+        if image.format == "GIF":
+            self.frame_count = image.n_frames
+            if stream_min_pixels is None:
+                stream_min_pixels = app.config['GIF_STREAM_MIN_PIXELS']
+            if image.width * image.height * self.frame_count < stream_min_pixels:
+                self.frames = []
+                self.durations = []
+                for frame in ImageSequence.Iterator(image):
+                    check_deadline()
+                    self.frames.append(self._shrink(frame.convert("RGB")))
+                    self.durations.append(frame.info.get('duration', 0))
+        elif 'A' in image.getbands() or 'transparency' in image.info:
+            image = self._shrink(image.convert("RGBA"))
+            self.alpha = image.getchannel("A")
+            self.frames = [image.convert("RGB")]
+            self.frame_count = 1
+        else:
+            self.frames = [self._shrink(image.convert("RGB"))]
+            self.frame_count = 1
+        if self.frames is not None:
+            self.decode_count += 1
+        self.timings['decode'] = time.perf_counter() - start
+        observe_stage('decode', self.timings['decode'], self.format, True)
+
+        # One pass over the frames into a shared histogram accumulator. Streamed GIFs are
+        # decoded here for the statistics and again frame by frame when rendered.
+        start = time.perf_counter()
+        if sample_size is None:
+            sample_size = app.config['ANALYSIS_SAMPLE_SIZE']
+        self.stats = HistogramStats(sample_size)
+        if self.frames is not None:
+            for frame in self.frames:
+                check_deadline()
+                self.stats.add(frame)
+        else:
+            self.durations = []
+            for frame in ImageSequence.Iterator(image):
+                check_deadline()
+                self.durations.append(frame.info.get('duration', 0))
+                self.stats.add(self._shrink(frame.convert("RGB")))
+            self.decode_count += 1
+        self.pixel_count = self.stats.pixel_count
+        self.mean_rgb = self.stats.mean_rgb
+        self.luminance_mean = self.stats.luminance_mean
+        self.luminance_p5 = self.stats.luminance_percentile(5)
+        self.luminance_p95 = self.stats.luminance_percentile(95)
+        self.timings['stats'] = time.perf_counter() - start
+        observe_stage('analysis', self.timings['stats'], self.format, True)
+
+    @classmethod
+    def from_asset(cls, asset, frames, alpha=None):
+        """An analysis of a registered background (see AssetRegistry) without decoding anything.
+
+        frames are the stored frames, already shrunk and inverted, and asset their metadata.
+        """
+        analysis = cls.__new__(cls)
+        analysis.timings = {}
+        analysis.decode_count = 0
+        analysis.inverted = asset['inverted']
+        analysis.source_size = tuple(asset['source_size'])
+        analysis.reduce_factor = 1
+        analysis.size = tuple(asset['size'])
+        analysis.format = asset['format']
+        analysis.mode = asset['mode']
+        analysis.info = {}
+        analysis.loop = asset['loop']
+        analysis.alpha = alpha
+        analysis.frames = frames
+        analysis.durations = asset['durations']
+        analysis.frame_count = len(frames)
+        analysis._source = None
+        analysis.stats = None
+        analysis.pixel_count = asset['pixel_count']
+        analysis.mean_rgb = np.array(asset['mean_rgb'])
+        analysis.luminance_mean = asset['luminance_mean']
+        analysis.luminance_p5 = asset['luminance_p5']
+        analysis.luminance_p95 = asset['luminance_p95']
+        return analysis
+
+    def _shrink(self, frame):
+        if self.reduce_factor > 1:
+            frame = frame.reduce(self.reduce_factor)
+        self.size = frame.size
+        return frame
+
+    @property
+    def is_animated(self):
+        return self.frame_count > 1
+
+    def iter_frames(self):
+        """Yields the RGB frames, inverted if invert_image was applied, one at a time."""
+        if self.frames is not None:
+            yield from self.frames
+            return
+
+        # A private stream per iteration so concurrent renders never share a file position
+        source = BytesIO(self._source.getvalue()) if isinstance(self._source, BytesIO) else self._source
+        self.decode_count += 1
+        for frame in ImageSequence.Iterator(Image.open(source)):
+            check_deadline()
+            frame = self._shrink(frame.convert("RGB"))
+            yield ImageOps.invert(frame) if self.inverted else frame
+
+    def server_timing(self):
+        """Formats the collected step timings as a Server-Timing header value."""
+        parts = [f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.timings.items()]
+        parts.append(f'decodes;desc="{self.decode_count}"')
+        if self.size != self.source_size:
+            parts.append(f'resize;desc="{self.source_size[0]}x{self.source_size[1]} to {self.size[0]}x{self.size[1]}"')
+        return ', '.join(parts)
+
+def get_opposite_dark_color(analysis):
+    """Returns a high-contrast dark color based on the majority color of the image."""
+    opposite_color = 255 - analysis.mean_rgb
     dark_color = tuple(max(0, min(100, int(c))) for c in opposite_color)
     return f'#{dark_color[0]:02x}{dark_color[1]:02x}{dark_color[2]:02x}'
 
-def is_image_dark(image_path):
-    try:
-        image = Image.open(image_path)
+def is_image_dark(analysis):
+    return analysis.luminance_mean < 128
 
-        if image.format == "GIF":
-            frames = [frame.convert("L") for frame in ImageSequence.Iterator(image)]
-            avg_luminance = sum(ImageStat.Stat(frame).mean[0] for frame in frames) / len(frames)
-        else:
-            image = image.convert("L")
-            avg_luminance = ImageStat.Stat(image).mean[0]
+def is_image_high_contrast(analysis):
+    contrast = analysis.luminance_p95 - analysis.luminance_p5
+    return contrast > 100
 
-        return avg_luminance < 128
+def invert_image(analysis):
+    """Inverts the decoded frames in place; streamed GIFs are inverted frame by frame while rendering."""
+    try:
+        start = time.perf_counter()
+        if analysis.frames is not None:
+            analysis.frames = [ImageOps.invert(frame) for frame in analysis.frames]
+
+        # The inverted background is opaque RGB, just like the PNG to_artistic used to read back.
+        # Keep the statistics in line with the inverted pixels for get_opposite_dark_color.
+        analysis.mode = "RGB"
+        analysis.alpha = None
+        analysis.mean_rgb = 255 - analysis.mean_rgb
+        analysis.inverted = True
+        analysis.timings['invert'] = time.perf_counter() - start
+        observe_stage('invert', analysis.timings['invert'], analysis.format, True)
     except Exception as e:
-        print(f"Error analyzing image brightness: {e}")
-        return False
+        print(f"Error inverting image: {e}")
 
-def is_image_high_contrast(image_path):
-    try:
-        image = Image.open(image_path)
-        if image.format == "GIF":
-            frames = [frame.convert("L") for frame in ImageSequence.Iterator(image)]
-            all_pixels = np.concatenate([np.array(frame).flatten() for frame in frames])
+# Module types that to_artistic always draws in the QR color, never from the background
+_KEEP_MODULES = (consts.TYPE_FINDER_PATTERN_DARK, consts.TYPE_FINDER_PATTERN_LIGHT, consts.TYPE_SEPARATOR,
+                 consts.TYPE_ALIGNMENT_PATTERN_DARK, consts.TYPE_ALIGNMENT_PATTERN_LIGHT, consts.TYPE_TIMING_DARK,
+                 consts.TYPE_TIMING_LIGHT)
+
+def pack_rows(rows, size):
+    """Packs size x size modules into bytes, each row padded to whole bytes (MSB first, like np.packbits)."""
+    row_bytes = (size + 7) // 8
+    padding = '0' * (row_bytes * 8 - size)
+    return b''.join(int(''.join('1' if module else '0' for module in row) + padding, 2).to_bytes(row_bytes, 'big')
+                    for row in rows)
+
+@functools.lru_cache(maxsize=None)
+def function_pattern_bits(size):
+    """Packed mask of the function pattern modules for a symbol size, see _KEEP_MODULES.
+
+    Where the function patterns are only depends on the size, so any matrix will do.
+    """
+    blank = tuple(bytearray(size) for _ in range(size))
+    return pack_rows(([module in _KEEP_MODULES for module in row]
+                      for row in segno_utils.matrix_iter_verbose(blank, (size, size), scale=1, border=0)), size)
+
+@functools.lru_cache(maxsize=None)
+def codeword_blocks(version, error):
+    """Maps the modules of a symbol to its Reed-Solomon blocks.
+
+    Returns (codewords, blocks, block_sizes): the codeword each module carries (-1 for function
+    patterns, format and version information and remainder bits), the block each codeword
+    belongs to and the number of codewords in each block. Codewords are placed with segno's own
+    placement and interleaved across blocks like segno's final message, data codewords first.
+    """
+    blocks = [(ec.num_data, ec.num_total - ec.num_data)
+              for ec in consts.ECC[version][consts.ERROR_MAPPING[error]] for _ in range(ec.num_blocks)]
+    owners = [block for index in range(max(data for data, _ in blocks))
+              for block, (data, _) in enumerate(blocks) if index < data]
+    owners += [block for index in range(max(ec for _, ec in blocks))
+               for block, (_, ec) in enumerate(blocks) if index < ec]
+
+    # Number every free module in placement order; segno marks the free ones with 0x2
+    size = segno_encoder.calc_matrix_size(version)
+    matrix = [list(row) for row in segno_encoder.make_matrix(size, size)]
+    segno_encoder.add_finder_patterns(matrix, size, size)
+    segno_encoder.add_alignment_patterns(matrix, size, size)
+    free = sum(row.count(0x2) for row in matrix)
+    segno_encoder.add_codewords(matrix, range(0x3, 0x3 + free), version)
+    bits = np.array(matrix, dtype=np.int64) - 0x3
+    codewords = np.where((bits >= 0) & (bits < len(owners) * 8), bits // 8, -1)
+    return codewords, np.array(owners), np.array([data + ec for data, ec in blocks])
+
+class EncodedQR:
+    """The bit-packed module matrix of an encoded payload, all that rendering needs from segno.QRCode."""
+
+    __slots__ = ('version', 'error', 'size', 'dark_bits')
+
+    def __init__(self, qr):
+        self.version = qr.version
+        self.error = qr.error
+        self.size = len(qr.matrix)
+        self.dark_bits = pack_rows(qr.matrix, self.size)
+
+    @property
+    def keep_bits(self):
+        return function_pattern_bits(self.size)
+
+    def _module_rows(self):
+        """Yields each matrix row as a string of '0' and '1'."""
+        row_bytes = (self.size + 7) // 8
+        padding = row_bytes * 8 - self.size
+        for start in range(0, len(self.dark_bits), row_bytes):
+            yield format(int.from_bytes(self.dark_bits[start:start + row_bytes], 'big') >> padding, f'0{self.size}b')
+
+    def write_png(self, out, scale=12, border=4, dark='#000', light='#fff', compresslevel=None):
+        """Writes a 1-bit palette PNG.
+
+        Each module row is widened with str.translate and packed with int(), then repeated
+        scale times, so the work per request is per module row rather than per pixel.
+        """
+        if compresslevel is None:
+            compresslevel = app.config['PNG_COMPRESS_LEVEL']
+        width = (self.size + 2 * border) * scale
+        row_bytes = (width + 7) // 8
+        quiet_zone = '0' * (border * scale)
+        padding = '0' * (row_bytes * 8 - width)
+        widen = {ord('0'): '0' * scale, ord('1'): '1' * scale}
+        blank = (b'\0' + bytes(row_bytes)) * (border * scale)
+
+        scanlines = [blank]
+        for modules in self._module_rows():
+            pixels = int(quiet_zone + modules.translate(widen) + quiet_zone + padding, 2).to_bytes(row_bytes, 'big')
+            scanlines.append((b'\0' + pixels) * scale)
+        scanlines.append(blank)
+
+        palette = bytes.fromhex(segno.writers.color_to_rgb_hex(light)[1:] + segno.writers.color_to_rgb_hex(dark)[1:])
+        out.write(b'\x89PNG\r\n\x1a\n')
+        out.write(_png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, width, 1, 3, 0, 0, 0)))
+        out.write(_png_chunk(b'PLTE', palette))
+        out.write(_png_chunk(b'IDAT', zlib.compress(b''.join(scanlines), compresslevel)))
+        out.write(_png_chunk(b'IEND', b''))
+
+    def write_svg(self, out, scale=12, border=4, dark='#000', light='#fff'):
+        """Writes an SVG with a single path: every run of dark modules in a row is one stroke."""
+        size = self.size + 2 * border
+        path = []
+        x, y = 0, 0.5
+        for row, modules in enumerate(self._module_rows(), start=border):
+            for run in re.finditer('1+', modules):
+                start = run.start() + border
+                path.append(f'm{start - x} {row + 0.5 - y:g}h{run.end() - run.start()}' if path
+                            else f'M{start} {row + 0.5:g}h{run.end() - run.start()}')
+                x, y = start + run.end() - run.start(), row + 0.5
+        svg = (f'<svg xmlns="http://www.w3.org/2000/svg" width="{size * scale}" height="{size * scale}" '
+               f'viewBox="0 0 {size} {size}" shape-rendering="crispEdges">'
+               f'<path fill="{segno.writers.color_to_rgb_hex(light)}" d="M0 0h{size}v{size}H0z"/>'
+               f'<path stroke="{segno.writers.color_to_rgb_hex(dark)}" d="{"".join(path)}"/></svg>')
+        out.write(svg.encode('ascii'))
+
+def _png_chunk(name, data):
+    return struct.pack('>I', len(data)) + name + data + struct.pack('>I', zlib.crc32(name + data))
+
+class MatrixCache:
+    """LRU cache of EncodedQR by payload, bounded by the size of the packed matrices."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _entry_size(data, encoded):
+        return len(data) + len(encoded.dark_bits)
+
+    def encode(self, data, error='H', boost_error=True):
+        """Returns the EncodedQR for data, encoding it with segno.make on a miss."""
+        key = (data, error, boost_error)
+        with self._lock:
+            encoded = self._entries.get(key)
+            if encoded is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return encoded
+            self.misses += 1
+
+        encoded = EncodedQR(segno.make(data, error=error, boost_error=boost_error))
+        entry_size = self._entry_size(data, encoded)
+        if entry_size > self.max_bytes:
+            return encoded
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = encoded
+                self._size += entry_size
+            while self._size > self.max_bytes:
+                (evicted_data, _, _), evicted = self._entries.popitem(last=False)
+                self._size -= self._entry_size(evicted_data, evicted)
+                self.evictions += 1
+        return encoded
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+matrix_cache = MatrixCache(app.config['MATRIX_CACHE_MAX_BYTES'])
+
+class ArtisticLayout:
+    """Pixel masks for blending a QR code into background frames with the same layout as qr.to_artistic.
+
+    Function patterns and the center third of every module keep the QR color; every other
+    pixel of the symbol area shows the resized, centered background. The masks are built
+    once so every frame of an animation is a single masked copy.
+    """
+
+    def __init__(self, qr, scale=12, border=4):
+        size = qr.size
+        self.size = size
+        self.scale = scale
+        self.width = size * scale
+        self.offset = border * scale
+        self.version = qr.version
+        self.error = qr.error
+        self.dark_modules = dark_modules = self._unpack(qr.dark_bits, size)
+        self.keep_modules = keep_modules = self._unpack(qr.keep_bits, size)
+
+        center = (np.arange(scale) // max(1, scale // 3)) % 3 == 1
+        center = np.tile(np.outer(center, center), (size, size))
+        keep = np.kron(keep_modules, np.ones((scale, scale), dtype=bool)).astype(bool)
+        self.background_mask = ~keep & ~center
+        self.dark_pixels = np.kron(np.pad(dark_modules, border), np.ones((scale, scale), dtype=bool)).astype(bool)
+
+    @staticmethod
+    def _unpack(bits, size):
+        return np.unpackbits(np.frombuffer(bits, dtype=np.uint8).reshape(size, -1), axis=1)[:, :size].astype(bool)
+
+    def composite(self, background, dark, alpha=None):
+        """Returns an RGB image, or RGBA if an alpha channel for the background is given."""
+        width = self.width
+
+        # Fit the background inside the symbol area, centered like to_artistic does
+        bg_width, bg_height = background.size
+        ratio = min(width / bg_width, width / bg_height)
+        resized_size = (int(bg_width * ratio), int(bg_height * ratio))
+        left = int(math.ceil((width - resized_size[0]) / 2))
+        top = int(math.ceil((width - resized_size[1]) / 2))
+        channels = 4 if alpha is not None else 3
+        bg = np.zeros((width, width, channels), dtype=np.uint8)
+        if alpha is not None:
+            background = background.convert("RGBA")
+            background.putalpha(alpha)
+        # Registered assets are mapped as RGBX, the padding byte is dropped here
+        resized = np.asarray(background.resize(resized_size, Image.LANCZOS))[..., :channels]
+        bg[top:top + resized_size[1], left:left + resized_size[0]] = resized
+        show_background = np.zeros((width, width), dtype=bool)
+        show_background[top:top + resized_size[1], left:left + resized_size[0]] = True
+        show_background &= self.background_mask
+        if alpha is not None:
+            show_background &= bg[..., 3] > 0
+
+        # Plain QR code in the requested color with a white quiet zone, then one masked copy
+        out = np.full(self.dark_pixels.shape + (channels,), 255, dtype=np.uint8)
+        out[self.dark_pixels, :3] = ImageColor.getrgb(dark)[:3]
+        symbol = out[self.offset:self.offset + width, self.offset:self.offset + width]
+        symbol[show_background] = bg[show_background]
+        return Image.fromarray(out, "RGBA" if alpha is not None else "RGB")
+
+def animation_palette(analysis, dark, sample_frames=8):
+    """A "P" image with one palette for a whole animation rendered in the dark color on this background.
+
+    The palette has the QR colors first, then 253 colors picked from a few of the background
+    frames, and no 256th entry so that index 255 is free to mark transparent pixels.
+    """
+    if analysis.frames is not None:
+        frames = [analysis.frames[index] for index in sample_frame_indices(analysis.frame_count, sample_frames)]
+    else:
+        frames = [next(analysis.iter_frames())]
+    thumbnails = []
+    for frame in frames:
+        frame = frame.convert("RGB")
+        frame.thumbnail((128, 128), Image.NEAREST)
+        thumbnails.append(frame)
+    mosaic = Image.new("RGB", (sum(thumbnail.width for thumbnail in thumbnails), max(thumbnail.height for thumbnail in thumbnails)))
+    left = 0
+    for thumbnail in thumbnails:
+        mosaic.paste(thumbnail, (left, 0))
+        left += thumbnail.width
+    background_colors = mosaic.quantize(253, method=Image.Quantize.MEDIANCUT).getpalette()[:253 * 3]
+
+    palette = Image.new("P", (1, 1))
+    palette.putpalette(bytes(ImageColor.getrgb(dark)[:3]) + b'\xff\xff\xff' + bytes(background_colors))
+    return palette
+
+def merge_repeated_frames(frames, threshold=0.0):
+    """Merges every frame that differs from the one kept before it in at most threshold of its
+    pixels into that frame, adding up the durations. Takes and yields (image, duration) lazily."""
+    pending = pending_pixels = None
+    for image, duration in frames:
+        pixels = np.asarray(image)
+        if pending is not None:
+            changed = pixels != pending_pixels
+            if changed.ndim == 3:
+                changed = changed.any(axis=2)
+            if changed.mean() <= threshold:
+                pending = (pending[0], pending[1] + duration)
+                continue
+            yield pending
+        pending, pending_pixels = (image, duration), pixels
+    if pending is not None:
+        yield pending
+
+def changed_box(changed):
+    """(top, bottom, left, right) of the rectangle around the True pixels of a 2D mask, at least 1x1."""
+    rows = np.flatnonzero(changed.any(axis=1))
+    columns = np.flatnonzero(changed.any(axis=0))
+    if not len(rows):
+        return 0, 1, 0, 1
+    return rows[0], rows[-1] + 1, columns[0], columns[-1] + 1
+
+class GifStreamWriter:
+    """Writes an animated GIF frame by frame so only the last few frames are held in memory.
+
+    Frames come in as RGB and are mapped to one palette (see animation_palette), written once as
+    the global color table. After the first frame only the rectangle that changed is encoded, with
+    the pixels inside it that did not change left transparent so the previous frame shows through.
+    A frame that replaces most of the previous one, and is mostly replaced by the next, is also
+    encoded whole with a color table of its own, as GIFs were written before the shared palette,
+    and the smaller encoding is kept. Each frame is written once the next one is known.
+    """
+
+    TRANSPARENT = 255
+
+    def __init__(self, fp, palette, loop=0):
+        self.fp = fp
+        self.palette = palette
+        self.loop = loop
+        self.frame_count = 0
+        self._previous = None
+        self._pending = None
+        self._drawn_in_palette = True
+
+    def add_frame(self, image, duration=0):
+        """Adds one RGB frame."""
+        indexed = image.quantize(palette=self.palette, dither=Image.Dither.NONE)
+        pixels = np.asarray(indexed)
+        if self._pending is not None:
+            self._write_pending(pixels)
+        self._pending = (image, indexed, pixels, duration)
+
+    def _write_pending(self, next_pixels=None):
+        image, indexed, pixels, duration = self._pending
+        if self._previous is None:
+            header, _ = GifImagePlugin.getheader(indexed, info={'loop': self.loop, 'optimize': False})
+            for chunk in header:
+                self.fp.write(chunk)
+            changed = np.ones(pixels.shape, dtype=bool)
         else:
-            image = image.convert("L")
-            all_pixels = np.array(image).flatten()
+            changed = pixels != self._previous
+        top, bottom, left, right = changed_box(changed)
+        area = (bottom - top) * (right - left) / pixels.size
 
-        dark_threshold = np.percentile(all_pixels, 5)
-        bright_threshold = np.percentile(all_pixels, 95)
+        if not self._drawn_in_palette:
+            # The previous frame is not in the shared palette's colors, so nothing can show through
+            region, offset, params = indexed, (0, 0), {}
+        else:
+            region = pixels[top:bottom, left:right]
+            region_changed = changed[top:bottom, left:right]
+            params = {}
+            # Scattered transparent pixels in a mostly changed region only break up LZW runs
+            if region_changed.mean() < 0.5:
+                region = np.where(region_changed, region, self.TRANSPARENT).astype(np.uint8)
+                params['transparency'] = self.TRANSPARENT
+            region = Image.fromarray(np.ascontiguousarray(region), "P")
+            offset = (int(left), int(top))
+        # Disposal 1 leaves each frame in place for the next one to draw over
+        chunks = GifImagePlugin.getdata(region, offset=offset, duration=duration, disposal=1, **params)
+        self._drawn_in_palette = True
+        if area >= 0.5 and next_pixels is not None:
+            next_top, next_bottom, next_left, next_right = changed_box(next_pixels != pixels)
+            area = min(area, (next_bottom - next_top) * (next_right - next_left) / pixels.size)
+        if area >= 0.5:
+            whole = GifImagePlugin.getdata(image.convert("P"), duration=duration, disposal=1, include_color_table=True)
+            if sum(map(len, whole)) < sum(map(len, chunks)):
+                chunks = whole
+                self._drawn_in_palette = False
+        for chunk in chunks:
+            self.fp.write(chunk)
+        self._previous = pixels
+        self._pending = None
+        self.frame_count += 1
+
+    def close(self):
+        if self._pending is not None:
+            self._write_pending()
+        self.fp.write(b";")
+
+def render_artistic(qr, analysis, target, kind, dark, layout=None, progress=None):
+    """Writes the QR code on top of the analysed background into target.
+
+    progress, if given, is called with (frames done, total frames) after each frame.
+    Returns the rendered frames picked by sample_frame_indices for the scannability check.
+    """
+    start = time.perf_counter()
+    layout = layout or ArtisticLayout(qr)
+    if analysis.is_animated:
+        sampled = set(sample_frame_indices(analysis.frame_count, app.config['SCAN_SAMPLE_FRAMES']))
+        rendered = []
+        # WebP frames stay RGB for its own lossy encoder, GIF and APNG frames share one palette
+        palette = animation_palette(analysis, dark) if kind != 'webp' else None
+
+        def composited():
+            for index, (frame, duration) in enumerate(zip(analysis.iter_frames(), analysis.durations)):
+                check_deadline()
+                image = layout.composite(frame, dark)
+                # GifStreamWriter maps frames to the palette itself
+                if palette is not None and kind != 'gif':
+                    image = image.quantize(palette=palette, dither=Image.Dither.NONE)
+                if index in sampled:
+                    rendered.append(image if kind != 'gif' else image.quantize(palette=palette, dither=Image.Dither.NONE))
+                if progress:
+                    progress(index + 1, analysis.frame_count)
+                yield image, duration
+
+        frames = merge_repeated_frames(composited(), app.config['ANIMATION_MERGE_THRESHOLD'])
+        if kind == 'gif':
+            writer = GifStreamWriter(target, palette, loop=analysis.loop)
+            for image, duration in frames:
+                writer.add_frame(image, duration)
+            writer.close()
+        else:
+            # PIL encodes WebP and APNG animations in one call, so the merged frames are held in memory
+            frames = list(frames)
+            images = [image for image, _ in frames]
+            options = {'quality': app.config['ANIMATION_WEBP_QUALITY']} if kind == 'webp' else {}
+            images[0].save(target, format='WEBP' if kind == 'webp' else 'PNG', save_all=True, append_images=images[1:],
+                           duration=[duration for _, duration in frames], loop=analysis.loop, **options)
+    else:
+        image = layout.composite(analysis.frames[0], dark, alpha=analysis.alpha)
+        if analysis.mode != image.mode:
+            image = image.convert(analysis.mode)
+        image.save(target, format=kind)
+        rendered = [image]
+        if progress:
+            progress(1, 1)
+    analysis.timings['composite'] = time.perf_counter() - start
+    observe_stage('composite', analysis.timings['composite'], kind, True)
+    return rendered
+
+def analyse_background(background, data=None):
+    """Decodes and analyses an uploaded background, inverting dark low-contrast images.
+
+    data is the payload (or the longest of several) whose symbol the background will fill,
+    used to shrink the background to a multiple of that size.
+    """
+    target_size = matrix_cache.encode(data).size * 12 if data else None
+    analysis = BackgroundAnalysis(background, target_size=target_size)
+    if is_image_dark(analysis) and not is_image_high_contrast(analysis):
+        invert_image(analysis)
+    metrics.inc('qr_invert_decisions_total', {'inverted': 'yes' if analysis.inverted else 'no'})
+    return analysis
+
+def render_qr(data, color='#000000', analysis=None, kind='png', check_scannable=False, progress=None):
+    """Renders one QR code, on top of an analysed background if one is given.
+
+    progress is passed on to render_artistic. Returns the encoded image as a BytesIO and a ScanScore, which is None for plain codes
+    (always scannable) and when check_scannable is off.
+    """
+    start = time.perf_counter()
+    qr = matrix_cache.encode(data)
+    observe_stage('encode', time.perf_counter() - start, kind, analysis is not None)
+    img_io = BytesIO()
+    score = None
 
-        contrast = bright_threshold - dark_threshold
-        return contrast > 100
-    except Exception as e:
-        print(f"Error analyzing image contrast: {e}")
-        return False
+    if analysis is not None:
+        layout = ArtisticLayout(qr)
+        rendered = render_artistic(qr, analysis, img_io, 'jpeg' if kind == 'jpg' else kind, color, layout=layout,
+                                   progress=progress)
+        img_io.seek(0)
 
-def invert_image(image_path):
+        # Check if the QR code is scannable, straight from the rendered frames
+        if check_scannable:
+            start = time.perf_counter()
+            score = score_scannability(layout, rendered)
+            analysis.timings['verify'] = time.perf_counter() - start
+            observe_stage('verify', analysis.timings['verify'], kind, True)
+    else:
+        # Plain QR codes should always be scannable
+        start = time.perf_counter()
+        if kind == 'svg':
+            qr.write_svg(img_io, scale=12, border=4, dark=color)
+        else:
+            qr.write_png(img_io, scale=12, border=4, dark=color)
+        img_io.seek(0)
+        observe_stage('render', time.perf_counter() - start, kind, False)
+        if progress:
+            progress(1, 1)
+
+    return img_io, score
+
+def candidate_colors(analysis, tried=()):
+    """Dark QR colors to try on a background, most similar to get_opposite_dark_color first."""
+    base = ImageColor.getrgb(get_opposite_dark_color(analysis))
+    hue, lightness, saturation = colorsys.rgb_to_hls(*(channel / 255 for channel in base))
+    candidates = []
+    for factor in (0.7, 0.45, 0.2):
+        candidates.append(colorsys.hls_to_rgb(hue, lightness * factor, saturation))
+    for shift in (1 / 6, -1 / 6, 1 / 3, -1 / 3, 1 / 2):
+        candidates.append(colorsys.hls_to_rgb((hue + shift) % 1, min(lightness, 0.25), max(saturation, 0.6)))
+    candidates.append((0, 0, 0))
+
+    colors = [get_opposite_dark_color(analysis)]
+    for rgb in candidates:
+        colors.append('#%02x%02x%02x' % tuple(int(round(channel * 255)) for channel in rgb))
+    tried = {color.lower() for color in tried}
+    return [color for color in dict.fromkeys(colors) if color not in tried]
+
+_color_search_pool = None
+_color_search_lock = threading.Lock()
+
+def search_scannable_color(data, analysis, kind, tried=()):
+    """Renders candidate colors concurrently and returns (img_io, score, color) for the first
+    one in candidate_colors order that passes the scannability check, or None if none do.
+
+    Results are taken in that order rather than as they complete, so the color picked does not
+    depend on which render happened to finish first.
+    """
+    global _color_search_pool
+    with _color_search_lock:
+        if _color_search_pool is None:
+            _color_search_pool = ThreadPoolExecutor(max_workers=app.config['COLOR_SEARCH_WORKERS'],
+                                                    thread_name_prefix='color-search')
+
+    start = time.perf_counter()
+    deadline = getattr(_render_budget, 'deadline', None)
+    futures = [(color, _color_search_pool.submit(_with_deadline, deadline, render_qr, data, color, analysis, kind, True))
+               for color in candidate_colors(analysis, tried)]
     try:
-        image = Image.open(image_path)
-        inverted_path = tempfile.NamedTemporaryFile(delete=False, suffix=".png").name
+        for color, future in futures:
+            check_deadline()
+            try:
+                img_io, score = future.result()
+            except Exception as e:
+                print(f"Error rendering candidate color {color}: {e}")
+                continue
+            if score.passed:
+                return img_io, score, color
+        return None
+    finally:
+        for _, future in futures:
+            future.cancel()
+        analysis.timings['color_search'] = time.perf_counter() - start
+        observe_stage('color_search', analysis.timings['color_search'], kind, True)
+
+class RenderCache:
+    """LRU cache of rendered QR codes bounded by total payload size, with an optional shared on-disk tier.
+
+    The disk tier is shared by every worker, so each one rescans it after writing a tenth of
+    disk_max_bytes and deletes the files with the oldest mtimes (refreshed on every disk hit)
+    until it is back under 90% of the limit."""
+
+    def __init__(self, max_bytes, directory=None, disk_max_bytes=0):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self._disk_size = 0
+        self._disk_entries = 0
+        self._disk_written = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._prune_disk()
+
+    @staticmethod
+    def make_key(data, color, contrast_qr, background_digest, kind, auto_color=False):
+        key = json.dumps([data, color, bool(contrast_qr), background_digest, kind, bool(auto_color)])
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """Returns (payload, verdict) for a cached render or None. verdict is None if never checked."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        if self.directory:
+            try:
+                with open(self._disk_path(key) + '.json') as meta_file:
+                    meta = json.load(meta_file)
+                with open(self._disk_path(key), 'rb') as payload_file:
+                    payload = payload_file.read()
+            except (OSError, ValueError):
+                pass
+            else:
+                # The mtime marks the last use, for pruning
+                with contextlib.suppress(OSError):
+                    os.utime(self._disk_path(key))
+                    os.utime(self._disk_path(key) + '.json')
+                with self._lock:
+                    self.disk_hits += 1
+                self._store(key, payload, meta['verdict'])
+                return payload, meta['verdict']
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, payload, verdict=None):
+        self._store(key, payload, verdict)
+        if self.directory:
+            # Write then rename so other workers never see a partial file
+            path = self._disk_path(key)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(f'{path}.{os.getpid()}.tmp', 'wb') as payload_file:
+                    payload_file.write(payload)
+                os.replace(f'{path}.{os.getpid()}.tmp', path)
+                with open(f'{path}.json.{os.getpid()}.tmp', 'w') as meta_file:
+                    json.dump({'verdict': verdict}, meta_file)
+                    written = len(payload) + meta_file.tell()
+                os.replace(f'{path}.json.{os.getpid()}.tmp', path + '.json')
+            except OSError as e:
+                print(f"Error writing render cache entry: {e}")
+                return
+            with self._disk_lock:
+                self._disk_size += written
+                self._disk_entries += 1
+                self._disk_written += written
+                if self.disk_max_bytes and self._disk_written >= self.disk_max_bytes // 10:
+                    self._prune_disk()
+
+    def _prune_disk(self):
+        """Rescans the disk tier and deletes the least recently used files if it is over its limit."""
+        files = []
+        try:
+            for shard in os.scandir(self.directory):
+                if not shard.is_dir():
+                    continue
+                for entry in os.scandir(shard.path):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue  # removed by another worker
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError as e:
+            print(f"Error scanning render cache directory: {e}")
+            return
+        size = sum(file_size for _, file_size, _ in files)
+        entries = sum(1 for _, _, path in files if not path.endswith(('.json', '.tmp')))
+        if self.disk_max_bytes and size > self.disk_max_bytes:
+            files.sort()
+            for _, file_size, path in files:
+                if size <= self.disk_max_bytes * 0.9:
+                    break
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(path)
+                size -= file_size
+                if not path.endswith(('.json', '.tmp')):
+                    entries -= 1
+                    self.disk_evictions += 1
+        self._disk_size = size
+        self._disk_entries = entries
+        self._disk_written = 0
+
+    def _store(self, key, payload, verdict):
+        if len(payload) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous[0])
+            self._entries[key] = (payload, verdict)
+            self._size += len(payload)
+            while self._size > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'disk_entries': self._disk_entries,
+                'disk_bytes': self._disk_size,
+                'disk_max_bytes': self.disk_max_bytes,
+                'disk_evictions': self.disk_evictions,
+            }
 
-        if image.format == "GIF":
-            frames = [ImageOps.invert(frame.convert("RGB")) for frame in ImageSequence.Iterator(image)]
-            frames[0].save(inverted_path, save_all=True, append_images=frames[1:])
-        else:
-            image = ImageOps.invert(image.convert("RGB"))
-            image.save(inverted_path)
+render_cache = RenderCache(app.config['RENDER_CACHE_MAX_BYTES'], app.config['RENDER_CACHE_DIR'],
+                           app.config['RENDER_CACHE_DISK_MAX_BYTES'])
+
+class AssetRegistry:
+    """Backgrounds uploaded once and reused by id, stored decoded with their analysis.
+
+    Each asset is a raw file of RGBX frames (shrunk and, if needed, already inverted) followed
+    by the alpha channel if there is one, next to a JSON file with the statistics. Workers map
+    the raw file read-only, so every process shares the same page cache copy and a request
+    only wraps the mapped frames in images. The id is a hash of the upload and the symbol size
+    it was shrunk for, so registering the same background again returns the same asset.
+
+    Using an asset touches its files; when the directory grows over max_bytes the assets
+    used least recently are deleted, whichever worker used them.
+    """
+
+    def __init__(self, directory, max_bytes, open_max):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.open_max = open_max
+        self._maps = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.registered = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_id(background, target_size):
+        digest = hashlib.sha256(background)
+        digest.update(f':{target_size}:{app.config["PRERESIZE_MULTIPLE"]}'.encode())
+        return digest.hexdigest()[:32]
+
+    def _path(self, asset_id, suffix):
+        return os.path.join(self.directory, asset_id + suffix)
+
+    def register(self, background, extension, data=None):
+        """Analyses and stores an uploaded background. Returns (metadata, created).
+
+        data is a payload (or the longest one) the background will be used with, so the frames
+        are stored shrunk for that symbol size; without it they are kept at full size.
+        """
+        target_size = matrix_cache.encode(data).size * 12 if data else None
+        asset_id = self.make_id(background, target_size)
+        asset = self.get(asset_id)
+        if asset is not None:
+            return asset, False
 
-        return inverted_path
-    except Exception as e:
-        print(f"Error inverting image: {e}")
-        return image_path
+        try:
+            analysis = analyse_background(BytesIO(background), data)
+        except GenerateError:
+            raise
+        except Exception as e:
+            raise GenerateError(f"Error reading background image: {e}")
+        width, height = analysis.size
+        raw_bytes = width * height * (4 * analysis.frame_count + (analysis.alpha is not None))
+        if raw_bytes > self.max_bytes:
+            raise GenerateError(f"Background too large to register ({raw_bytes} bytes decoded), "
+                                f"the limit is {self.max_bytes} bytes.", 413)
+
+        asset = {
+            'id': asset_id,
+            'format': analysis.format,
+            'extension': extension,
+            'mode': analysis.mode,
+            'size': list(analysis.size),
+            'source_size': list(analysis.source_size),
+            'frame_count': analysis.frame_count,
+            'durations': analysis.durations or [0],
+            'loop': analysis.loop,
+            'has_alpha': analysis.alpha is not None,
+            'inverted': analysis.inverted,
+            'pixel_count': analysis.pixel_count,
+            'mean_rgb': [float(channel) for channel in analysis.mean_rgb],
+            'luminance_mean': analysis.luminance_mean,
+            'luminance_p5': analysis.luminance_p5,
+            'luminance_p95': analysis.luminance_p95,
+            'bytes': raw_bytes,
+            'target_size': target_size,
+        }
+        # Raw frames first and metadata last, each written then renamed, so a reader that finds
+        # the JSON always finds the complete frames
+        os.makedirs(self.directory, exist_ok=True)
+        raw_path = self._path(asset_id, '.raw')
+        meta_path = self._path(asset_id, '.json')
+        with open(f'{raw_path}.{os.getpid()}.tmp', 'wb') as raw_file:
+            for frame in analysis.iter_frames():
+                raw_file.write(frame.convert('RGBX').tobytes())
+            if analysis.alpha is not None:
+                raw_file.write(analysis.alpha.tobytes())
+        os.replace(f'{raw_path}.{os.getpid()}.tmp', raw_path)
+        with open(f'{meta_path}.{os.getpid()}.tmp', 'w') as meta_file:
+            json.dump(asset, meta_file)
+        os.replace(f'{meta_path}.{os.getpid()}.tmp', meta_path)
+        with self._lock:
+            self.registered += 1
+        self.evict(keep=asset_id)
+        return asset, True
+
+    def get(self, asset_id):
+        """Returns the metadata of an asset and marks it as used, or None if there is no such asset."""
+        if not re.fullmatch(r'[0-9a-f]{32}', asset_id or ''):
+            return None
+        try:
+            # The touch is also how other workers learn the asset is still in use
+            os.utime(self._path(asset_id, '.raw'))
+            with open(self._path(asset_id, '.json')) as meta_file:
+                return json.load(meta_file)
+        except (OSError, ValueError):
+            return None
+
+    def analysis(self, asset_id):
+        """A BackgroundAnalysis over the mapped frames of an asset, or None if it was deleted."""
+        start = time.perf_counter()
+        asset = self.get(asset_id)
+        if asset is None:
+            with self._lock:
+                self._maps.pop(asset_id, None)
+                self.misses += 1
+            return None
+
+        with self._lock:
+            mapped = self._maps.get(asset_id)
+            if mapped is not None:
+                self._maps.move_to_end(asset_id)
+                self.hits += 1
+        if mapped is None:
+            with open(self._path(asset_id, '.raw'), 'rb') as raw_file:
+                mapped = mmap.mmap(raw_file.fileno(), 0, access=mmap.ACCESS_READ)
+            with self._lock:
+                self.misses += 1
+                self._maps[asset_id] = mapped
+                # Images rendering right now keep their map alive, it is unmapped once they are gone
+                while len(self._maps) > self.open_max:
+                    self._maps.popitem(last=False)
+
+        width, height = asset['size']
+        frame_bytes = width * height * 4
+        view = memoryview(mapped)
+        frames = [Image.frombuffer('RGBX', (width, height), view[index * frame_bytes:(index + 1) * frame_bytes],
+                                   'raw', 'RGBX', 0, 1) for index in range(asset['frame_count'])]
+        alpha = None
+        if asset['has_alpha']:
+            offset = asset['frame_count'] * frame_bytes
+            alpha = Image.frombuffer('L', (width, height), view[offset:offset + width * height], 'raw', 'L', 0, 1)
+        analysis = BackgroundAnalysis.from_asset(asset, frames, alpha)
+        analysis.timings['asset'] = time.perf_counter() - start
+        return analysis
+
+    def delete(self, asset_id):
+        """Deletes an asset, returns False if there was none."""
+        if self.get(asset_id) is None:
+            return False
+        for suffix in ('.json', '.raw'):
+            try:
+                os.remove(self._path(asset_id, suffix))
+            except OSError:
+                pass
+        with self._lock:
+            self._maps.pop(asset_id, None)
+        return True
+
+    def _entries(self):
+        """(last used, bytes, id) of every stored asset."""
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return entries
+        for name in names:
+            if name.endswith('.raw'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name[:-4]))
+        return entries
+
+    def evict(self, keep=None):
+        """Deletes the least recently used assets until the directory is under max_bytes."""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, asset_id in entries:
+            if total <= self.max_bytes:
+                break
+            if asset_id == keep:
+                continue
+            if self.delete(asset_id):
+                total -= size
+                with self._lock:
+                    self.evictions += 1
+
+    def stats(self):
+        entries = self._entries()
+        with self._lock:
+            return {
+                'assets': len(entries),
+                'bytes': sum(size for _, size, _ in entries),
+                'max_bytes': self.max_bytes,
+                'mapped': len(self._maps),
+                'hits': self.hits,
+                'misses': self.misses,
+                'registered': self.registered,
+                'evictions': self.evictions,
+            }
+
+asset_registry = AssetRegistry(app.config['ASSET_DIR'], app.config['ASSET_MAX_BYTES'], app.config['ASSET_OPEN_MAX'])
+
+@functools.lru_cache(maxsize=1)
+def index_bodies():
+    """The index page by content coding, each with its own strong ETag, compressed on first use."""
+    body = HTML_TEMPLATE.encode('utf-8')
+    tag = hashlib.sha256(body).hexdigest()[:32]
+    bodies = {'identity': (body, tag), 'gzip': (gzip.compress(body, 9, mtime=0), f'{tag}-gz')}
+    if brotli is not None:
+        bodies['br'] = (brotli.compress(body, quality=11), f'{tag}-br')
+    return bodies
 
 @app.route('/')
 def index():
-    return HTML_TEMPLATE
-
-@app.route('/generate', methods=['POST'])
-def generate_qr():
+    bodies = index_bodies()
+    coding = request.accept_encodings.best_match([coding for coding in ('br', 'gzip') if coding in bodies]) or 'identity'
+    body, tag = bodies[coding]
+    response = Response(body, mimetype='text/html')
+    response.set_etag(tag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    if coding != 'identity':
+        response.headers['Content-Encoding'] = coding
+    if tag in request.if_none_match:
+        response.status_code = 304
+        response.set_data(b'')
+    return response
+
+class GenerateError(Exception):
+    """A problem with a /generate request that is reported back to the client, as a 400 by default."""
+
+    def __init__(self, message, status=400, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+PLAIN_ONLY_MESSAGE = "This server only renders plain QR codes, background images are not supported."
+
+class Counters:
+    """Thread-safe named counters, reported by /stats."""
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, amount=1):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+# Uploads accepted, refused (by reason) and downscaled, and the bytes and pixels that were never read or decoded
+intake_counters = Counters()
+
+class DeadlineExceeded(GenerateError):
+    """Raised by check_deadline in a render that ran past its wall-clock deadline."""
+
+    def __init__(self, seconds):
+        super().__init__(f"Rendering took longer than {seconds:g} seconds and was stopped.", 504)
+
+# Deadline of the render running on each thread, set by AdmissionControl.admit: (monotonic time, seconds) or None
+_render_budget = threading.local()
+
+def check_deadline():
+    """Raises DeadlineExceeded if the render on this thread is past its deadline. Called once per frame."""
+    deadline = getattr(_render_budget, 'deadline', None)
+    if deadline is not None and time.monotonic() > deadline[0]:
+        raise DeadlineExceeded(deadline[1])
+
+def _with_deadline(deadline, func, *args):
+    """Runs func on a pool thread under the deadline of the render that submitted it."""
+    _render_budget.deadline = deadline
+    try:
+        return func(*args)
+    finally:
+        _render_budget.deadline = None
+
+class AdmissionControl:
+    """Admits renders into concurrency pools by their cost, known from the image header before decoding.
+
+    Plain codes, static backgrounds and animated backgrounds each have a limit on concurrent
+    renders, so a burst of large GIFs cannot take the CPUs and memory plain codes need; a
+    render over its pool's limit is refused with 503 and a Retry-After from recent render times.
+    Every render is also held to a pixel budget (width x height x frames as decoded) and runs
+    under a wall-clock deadline, see check_deadline.
+    """
+
+    def __init__(self, limits, pixel_budget):
+        self.limits = limits
+        self.pixel_budget = pixel_budget
+        self._active = dict.fromkeys(limits, 0)
+        self._durations = {pool: deque(maxlen=50) for pool in limits}
+        self._rejected = Counters()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def pool_for(options):
+        if not options['has_background']:
+            return 'plain'
+        return 'animated' if options.get('frames', 1) > 1 else 'static'
+
+    def _reject(self, pool, reason):
+        self._rejected.inc(f'{pool}_{reason}')
+        metrics.inc('qr_admission_rejected_total', {'pool': pool, 'reason': reason})
+
+    @contextlib.contextmanager
+    def admit(self, options, deadline, pooled=True):
+        """Runs the body as an admitted render, raising GenerateError if it is refused.
+
+        Renders that already wait in a queue of their own (jobs) pass pooled=False to skip the
+        concurrency limit but keep the budget and deadline.
+        """
+        pool = self.pool_for(options)
+        pixels = options.get('pixels', 0)
+        if pixels > self.pixel_budget:
+            self._reject(pool, 'pixels')
+            raise GenerateError(f"Background too large to render ({pixels} pixels over all frames), "
+                                f"the budget is {self.pixel_budget} pixels.", 413)
+        if pooled:
+            with self._lock:
+                admitted = self._active[pool] < self.limits[pool]
+                if admitted:
+                    self._active[pool] += 1
+            if not admitted:
+                self._reject(pool, 'saturated')
+                raise GenerateError(f"Too many {pool} renders in progress, please retry later.", 503,
+                                    headers={'Retry-After': str(self.retry_after(pool))})
+
+        previous = getattr(_render_budget, 'deadline', None)
+        _render_budget.deadline = (time.monotonic() + deadline, deadline) if deadline else None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            _render_budget.deadline = previous
+            with self._lock:
+                self._durations[pool].append(time.perf_counter() - start)
+                if pooled:
+                    self._active[pool] -= 1
+
+    def retry_after(self, pool):
+        """Seconds until a slot in pool is likely to be free, from recent render times."""
+        with self._lock:
+            if not self._durations[pool]:
+                return 1
+            average = sum(self._durations[pool]) / len(self._durations[pool])
+            # A pool with a limit of 0 is closed and refuses everything
+            return max(1, math.ceil(average * self._active[pool] / max(1, self.limits[pool])))
+
+    def stats(self):
+        rejected = self._rejected.snapshot()
+        with self._lock:
+            return {pool: {'active': self._active[pool], 'limit': self.limits[pool],
+                           'rejected_saturated': rejected.get(f'{pool}_saturated', 0),
+                           'rejected_pixels': rejected.get(f'{pool}_pixels', 0)}
+                    for pool in self.limits}
+
+admission = AdmissionControl({'plain': app.config['ADMIT_PLAIN'], 'static': app.config['ADMIT_STATIC'],
+                              'animated': app.config['ADMIT_ANIMATED']}, app.config['PIXEL_BUDGET'])
+
+class ImageProbe:
+    """Format, size and frame count of an image read from its header, without decoding pixels.
+
+    width and height are None if the header is not complete in the bytes given.
+    """
+
+    def __init__(self, format, width=None, height=None, frame_count=1):
+        self.format = format
+        self.width = width
+        self.height = height
+        self.frame_count = frame_count
+
+    @property
+    def pixels(self):
+        return self.width * self.height
+
+    @property
+    def decoded_pixels(self):
+        """Pixels over all frames as BackgroundAnalysis decodes them: oversized JPEGs at their draft scale."""
+        scale = jpeg_draft_scale(self.width, self.height, app.config['MAX_IMAGE_PIXELS']) if self.format == 'JPEG' else 1
+        return math.ceil(self.width / (scale or 8)) * math.ceil(self.height / (scale or 8)) * self.frame_count
+
+def sniff_format(head):
+    """The real format of an upload from its first bytes: 'PNG', 'JPEG', 'GIF' or None."""
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'PNG'
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'JPEG'
+    if head.startswith((b'GIF87a', b'GIF89a')):
+        return 'GIF'
+    return None
+
+def probe_image(data):
+    """Returns an ImageProbe for PNG, JPEG or GIF bytes, or None for anything else."""
+    format = sniff_format(data)
+    if format == 'PNG':
+        if len(data) < 24 or data[12:16] != b'IHDR':
+            return ImageProbe(format)
+        return ImageProbe(format, *struct.unpack('>II', data[16:24]))
+
+    if format == 'JPEG':
+        # Walk the marker segments up to the first start-of-frame, which has the size
+        position = 2
+        while position + 4 <= len(data):
+            if data[position] != 0xFF:
+                break
+            marker = data[position + 1]
+            if marker == 0xFF:
+                position += 1
+                continue
+            if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+                position += 2
+                continue
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                if position + 9 > len(data):
+                    break
+                height, width = struct.unpack('>HH', data[position + 5:position + 9])
+                return ImageProbe(format, width, height)
+            position += 2 + struct.unpack('>H', data[position + 2:position + 4])[0]
+        return ImageProbe(format)
+
+    if format == 'GIF':
+        if len(data) < 13:
+            return ImageProbe(format)
+        width, height, flags = struct.unpack('<HHB', data[6:11])
+        position = 13 + (3 << ((flags & 7) + 1) if flags & 0x80 else 0)
+        frames = 0
+        # Count image descriptors, skipping color tables and data sub-blocks without decompressing them
+        while position < len(data):
+            block = data[position]
+            if block == 0x2C:
+                frames += 1
+                if position + 10 > len(data):
+                    break
+                local_flags = data[position + 9]
+                position += 10 + (3 << ((local_flags & 7) + 1) if local_flags & 0x80 else 0) + 1
+            elif block == 0x21:
+                position += 2
+            else:
+                break
+            while position < len(data) and data[position]:
+                position += data[position] + 1
+            position += 1
+        return ImageProbe(format, width, height, max(frames, 1))
+    return None
+
+def jpeg_draft_scale(width, height, max_pixels):
+    """The JPEG DCT scale (1, 2, 4 or 8) that brings an image under max_pixels, or None if 8 is not enough."""
+    for scale in (1, 2, 4, 8):
+        if math.ceil(width / scale) * math.ceil(height / scale) <= max_pixels:
+            return scale
+    return None
+
+def check_probe(probe, unread_bytes=0):
+    """Raises GenerateError if the header says the image is over the limits, counting the refusal."""
+    if probe.frame_count > app.config['MAX_FRAMES']:
+        reason = 'frames'
+        message = f"Too many frames, the limit is {app.config['MAX_FRAMES']}."
+    elif probe.pixels > app.config['MAX_IMAGE_PIXELS'] and not (
+            probe.format == 'JPEG' and jpeg_draft_scale(probe.width, probe.height, app.config['MAX_IMAGE_PIXELS'])):
+        reason = 'dimensions'
+        message = f"Image too large ({probe.width}x{probe.height}), the limit is {app.config['MAX_IMAGE_PIXELS']} pixels."
+    else:
+        return
+    intake_counters.inc(f'rejected_{reason}')
+    intake_counters.inc('bytes_skipped', unread_bytes)
+    intake_counters.inc('pixels_skipped', probe.pixels * probe.frame_count)
+    raise GenerateError(message, 413)
+
+def sniff_upload(head, unread_bytes):
+    """Returns the ImageProbe of the first bytes of an upload, raising GenerateError if they are not
+    a PNG, JPEG or GIF or their header is over the limits, and counting the refusal."""
+    probe = probe_image(head)
+    if probe is None:
+        intake_counters.inc('rejected_format')
+        intake_counters.inc('bytes_skipped', unread_bytes)
+        raise GenerateError("Invalid file format. Please upload a PNG, JPG, or GIF image.", 415)
+    if probe.width is not None:
+        # For GIFs the frames counted so far are a lower bound
+        check_probe(probe, unread_bytes)
+    return probe
+
+class UploadBuffer(BytesIO):
+    """The in-memory file an uploaded background is parsed into, checked as the parser writes it.
+
+    The format is sniffed and the header checked against the limits once the first
+    sniff_bytes have arrived, and never more than MAX_UPLOAD_BYTES are kept. A failed check
+    raises GenerateError from the multipart parser, so the rest of the request body is never
+    read.
+    """
+
+    sniff_bytes = 64 * 1024
+
+    def __init__(self, total_content_length):
+        super().__init__()
+        self.total_content_length = total_content_length or 0
+        self.started = time.perf_counter()
+        self.probe = None
+
+    def write(self, data):
+        written = super().write(data)
+        received = self.tell()
+        if received > app.config['MAX_UPLOAD_BYTES']:
+            intake_counters.inc('rejected_bytes')
+            intake_counters.inc('bytes_skipped', max(0, self.total_content_length - received))
+            raise GenerateError(f"Image too large, the limit is {app.config['MAX_UPLOAD_BYTES']} bytes.", 413)
+        if self.probe is None and received >= self.sniff_bytes:
+            self.probe = sniff_upload(self.getvalue(), max(0, self.total_content_length - received))
+        return written
+
+class UploadRequest(Request):
+    """Parses file fields named like an image into an UploadBuffer instead of a spooled temporary file."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if os.path.splitext(filename or '')[1].lower() in ('.png', '.jpg', '.jpeg', '.gif'):
+            return UploadBuffer(total_content_length)
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+app.request_class = UploadRequest
+
+def read_upload(file):
+    """Returns an uploaded background as (bytes, ImageProbe).
+
+    UploadBuffer sniffed and capped the upload while the request body was parsed; here the
+    complete header is checked, and uploads smaller than its first chunk are sniffed.
+    """
+    buffer = file.stream
+    if not isinstance(buffer, UploadBuffer):
+        buffer = UploadBuffer(request.content_length)
+        shutil.copyfileobj(file.stream, buffer, UploadBuffer.sniff_bytes)
+    data = buffer.getvalue()
+    if buffer.probe is None:
+        sniff_upload(data, 0)
+
+    probe = probe_image(data)
+    if probe.width is None:
+        intake_counters.inc('rejected_header')
+        raise GenerateError("Error reading background image: incomplete or corrupt header")
+    check_probe(probe)
+
+    scale = jpeg_draft_scale(probe.width, probe.height, app.config['MAX_IMAGE_PIXELS']) if probe.format == 'JPEG' else 1
+    if scale > 1:
+        intake_counters.inc('downscaled')
+        intake_counters.inc('pixels_skipped', probe.pixels - math.ceil(probe.width / scale) * math.ceil(probe.height / scale))
+    intake_counters.inc('accepted')
+    intake_counters.inc('bytes_received', len(data))
+    observe_stage('upload', time.perf_counter() - buffer.started, probe.format, True)
+    return data, probe
+
+def upload_extension(file_ext, probe):
+    """The output extension for a background: the uploaded one unless the content is another format."""
+    if probe.format == 'JPEG':
+        return file_ext if file_ext in ('jpg', 'jpeg') else 'jpg'
+    return probe.format.lower()
+
+@app.errorhandler(GenerateError)
+def generate_error(e):
+    # Raised by UploadBuffer while request.form or request.files is first read
+    return str(e), e.status, e.headers
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    intake_counters.inc('rejected_bytes')
+    intake_counters.inc('bytes_skipped', request.content_length or 0)
+    return f"Upload too large, the limit is {app.config['MAX_CONTENT_LENGTH']} bytes.", 413
+
+def read_generate_form():
+    """Validates the /generate form of the current request and returns the render options."""
     data = request.form.get('data')
     file = request.files.get('file')
+    background_id = request.form.get('background_id')
     filename = request.form.get('filename') or 'qr_code'
-    color = request.form.get('color', '#000000')
-    bw = request.form.get('bw')
-    contrast_qr = request.form.get('contrast_qr')  # Checkbox for high contrast QR color
     check_scannable = request.form.get('check_scannable', 'false') == 'true'  # New parameter
 
     if not data:
-        return "No data provided", 400
-
-    filename = secure_filename(filename)
-    file_extension = 'png'
-    qr = segno.make(data, error='H', boost_error=True)
-    temp_file_path = None
-
+        raise GenerateError("No data provided")
+
+    options = {
+        'data': data,
+        'filename': secure_filename(filename),
+        'color': request.form.get('color', '#000000'),
+        'contrast_qr': request.form.get('contrast_qr'),  # Checkbox for high contrast QR color
+        'check_scannable': check_scannable,
+        'auto_color': check_scannable and request.form.get('auto_color') in ('true', 'on'),  # Search for a scannable color
+        'file_extension': 'png',
+        'background': None,
+        'background_id': None,
+        # Kept when a finished job drops the uploaded background
+        'has_background': bool(file or background_id),
+    }
+
+    if (file or background_id) and app.config['PLAIN_ONLY']:
+        raise GenerateError(PLAIN_ONLY_MESSAGE, 415)
+    if file and background_id:
+        raise GenerateError("Upload a background image or give a background_id, not both.")
+
+    # Plain codes can be vector output, asked for with format=svg or an Accept header preferring SVG
+    output_format = request.form.get('format', '').lower()
+    if output_format not in ('', 'png', 'svg', 'webp', 'apng'):
+        raise GenerateError("Invalid output format. Please choose png, svg, webp or apng.")
+    if (file or background_id) and output_format == 'svg':
+        raise GenerateError("SVG output is only available for QR codes without a background image.")
+    animated_message = "WebP and APNG output are only available for GIF backgrounds."
+    if not (file or background_id) and output_format in ('webp', 'apng'):
+        raise GenerateError(animated_message)
+    if not (file or background_id) and (output_format == 'svg' or (not output_format and request.accept_mimetypes.best_match(
+            ['image/png', 'image/svg+xml']) == 'image/svg+xml')):
+        options['file_extension'] = 'svg'
     if file:
         uploaded_filename = secure_filename(file.filename)
         allowed_extensions = {'.png', '.jpg', '.jpeg', '.gif'}
         file_ext = os.path.splitext(uploaded_filename)[1].lower()
         if file_ext not in allowed_extensions:
-            return "Invalid file format. Please upload a PNG, JPG, or GIF image.", 400
-
-        temp_file = tempfile.NamedTemporaryFile(delete=False, dir=app.config['UPLOAD_FOLDER'], suffix=file_ext)
-        file.save(temp_file.name)
-        temp_file_path = temp_file.name
-
-        if is_image_dark(temp_file_path) and not is_image_high_contrast(temp_file_path):
-            temp_file_path = invert_image(temp_file_path)
-
-        file_extension = file_ext[1:].lower()
-
-    if contrast_qr and temp_file_path:  # If the checkbox is checked, apply opposite color
-        color = get_opposite_dark_color(temp_file_path)
-
-    img_io = BytesIO()
-    is_scannable = True
-
-    if temp_file_path:
+            raise GenerateError("Invalid file format. Please upload a PNG, JPG, or GIF image.")
+
+        options['background'], probe = read_upload(file)
+        options['file_extension'] = upload_extension(file_ext[1:], probe)
+        options['pixels'], options['frames'] = probe.decoded_pixels, probe.frame_count
+    if background_id:
+        asset = asset_registry.get(background_id)
+        if asset is None:
+            raise GenerateError("Unknown background_id, register the background again with POST /assets.", 404)
+        options['background_id'] = asset['id']
+        options['file_extension'] = asset['extension']
+        options['pixels'] = asset['size'][0] * asset['size'][1] * asset['frame_count']
+        options['frames'] = asset['frame_count']
+    # Animated backgrounds can be written as animated WebP or PNG instead of GIF
+    if output_format in ('webp', 'apng'):
+        if options['file_extension'] != 'gif':
+            raise GenerateError(animated_message)
+        options['file_extension'] = 'webp' if output_format == 'webp' else 'png'
+    return options
+
+def render_key(options):
+    """The render cache key of the code read_generate_form describes: a hash of every input that decides its bytes."""
+    if 'cache_key' not in options:
+        background_id = options.get('background_id')
+        if background_id is not None:
+            background_digest = f'asset:{background_id}'
+        elif options['background'] is not None:
+            background_digest = hashlib.sha256(options['background']).hexdigest()
+        else:
+            background_digest = None
+        options['cache_key'] = RenderCache.make_key(options['data'], options['color'], options['contrast_qr'], background_digest,
+                                                    options['file_extension'], options['auto_color'] and background_digest is not None)
+    return options['cache_key']
+
+def result_etag(options):
+    """Strong ETag of the image /generate sends for these options.
+
+    Rendering is deterministic, so it is the render key. A code on a background that passed a
+    scannability check gets a tag of its own: without the check the same inputs are sent even
+    when they are not scannable.
+    """
+    if options['check_scannable'] and options['has_background']:
+        return hashlib.sha256(f"{render_key(options)}:checked".encode()).hexdigest()
+    return render_key(options)
+
+def run_generate(options, progress=None, job=False):
+    """Renders the code described by read_generate_form, going through the render cache.
+
+    Cache misses are rendered under admission control; job renders skip the concurrency pools
+    and have the longer JOB_DEADLINE. Returns (img_io, verdict, analysis, cache status).
+    progress is passed on to render_qr.
+    """
+    cache_key = render_key(options)
+    cached = render_cache.get(cache_key)
+    if cached:
+        payload, verdict = cached
+        img_io = BytesIO(payload)
+        if options['check_scannable'] and verdict is None:
+            # Scored from the cached frames the same way a miss scores what it renders
+            has_background = options['has_background']
+            score = score_encoded_image(img_io, options['data']) if has_background else None
+            if score:
+                verdict = score.as_dict()
+                if not options['contrast_qr']:
+                    verdict['color'] = options['color']
+            else:
+                verdict = {'scannable': not has_background}
+            render_cache.put(cache_key, payload, verdict)
+        if progress:
+            progress(1, 1)
+        return img_io, verdict, None, 'hit'
+
+    deadline = app.config['JOB_DEADLINE' if job else 'GENERATE_DEADLINE']
+    with admission.admit(options, deadline, pooled=not job):
+        img_io, verdict, analysis = _render_generate(options, cache_key, progress)
+    return img_io, verdict, analysis, 'miss'
+
+def _render_generate(options, cache_key, progress):
+    """The cache miss half of run_generate. Returns (img_io, verdict, analysis)."""
+    data = options['data']
+    color = options['color']
+    file_extension = options['file_extension']
+    check_scannable = options['check_scannable']
+    background = options['background']
+    background_id = options.get('background_id')
+    has_background = options['has_background']
+    auto_color = options['auto_color'] and has_background
+    analysis = None
+
+    if background_id is not None:
+        # Decoded, shrunk and inverted when it was registered
+        analysis = asset_registry.analysis(background_id)
+        if analysis is None:
+            raise GenerateError("Unknown background_id, register the background again with POST /assets.", 404)
+    elif background is not None:
         try:
-            output_qr_path = tempfile.NamedTemporaryFile(delete=False, suffix=f".{file_extension}").name
-            qr.to_artistic(background=temp_file_path, target=output_qr_path, scale=12, border=4, kind='jpeg' if file_extension == 'jpg' else file_extension, dark=color)
-
-            # Check if the QR code is scannable
-            if check_scannable:
-                is_scannable = is_qr_code_scannable(output_qr_path)
+            analysis = analyse_background(BytesIO(background), data)
+        except GenerateError:
+            raise
+        except Exception as e:
+            raise GenerateError(f"Error reading background image: {e}")
 
-            with open(output_qr_path, "rb") as qr_file:
-                img_io.write(qr_file.read())
+    if analysis is not None and options['contrast_qr']:  # If the checkbox is checked, apply opposite color
+        color = get_opposite_dark_color(analysis)
 
-            img_io.seek(0)
-        except Exception as e:
-            return f"Error generating QR code with background: {e}", 400
-        finally:
-            if temp_file_path:
-                os.unlink(temp_file_path)
-            if 'output_qr_path' in locals() and os.path.exists(output_qr_path):
-                os.unlink(output_qr_path)
+    try:
+        img_io, score = render_qr(data, color, analysis, file_extension, check_scannable, progress=progress)
+    except GenerateError:
+        raise
+    except Exception as e:
+        if analysis is None:
+            raise
+        raise GenerateError(f"Error generating QR code with background: {e}")
+
+    if auto_color and score and not score.passed:
+        found = search_scannable_color(data, analysis, file_extension, tried=[color])
+        if found:
+            img_io, score, color = found
+
+    if score:
+        verdict = {**score.as_dict(), 'color': color}
+        if not score.passed:
+            metrics.inc('qr_unscannable_total', {'kind': _KIND_LABELS.get(file_extension, file_extension)})
+    elif check_scannable or not has_background:
+        verdict = {'scannable': True}
     else:
-        qr.save(img_io, kind='png', scale=12, border=4, dark=color)
-        img_io.seek(0)
-        # Plain QR codes should always be scannable
-        is_scannable = True
+        verdict = None
+    render_cache.put(cache_key, img_io.getvalue(), verdict)
+    return img_io, verdict, analysis
 
+def _render_labels(options):
+    return {'kind': _KIND_LABELS.get(options['file_extension'], options['file_extension']),
+            'background': 'yes' if options['has_background'] else 'no'}
+
+@app.route('/generate', methods=['POST'])
+@profiled
+def generate_qr():
+    try:
+        options = read_generate_form()
+        g.render_labels = _render_labels(options)
+        # The client already has exactly this image, nothing to render
+        if result_etag(options) in request.if_none_match:
+            return _not_modified(options)
+        img_io, verdict, analysis, cache_status = run_generate(options)
+    except GenerateError as e:
+        return str(e), e.status, e.headers
+    return _qr_response(img_io, options['filename'], options['file_extension'], options['check_scannable'],
+                        verdict, analysis, cache_status, options)
+
+def permalink(options):
+    """The immutable GET URL of a plain code, or None if it has a background or too much data for a URL."""
+    if (options['has_background'] or options['contrast_qr']
+            or len(options['data']) > app.config['PERMALINK_MAX_DATA']):
+        return None
+    return url_for('qr_permalink', key=render_key(options), ext=options['file_extension'],
+                   data=options['data'], color=options['color'])
+
+def _not_modified(options):
+    response = Response(status=304)
+    response.set_etag(result_etag(options))
+    response.headers['Vary'] = 'Accept'
+    return response
+
+def _qr_response(img_io, filename, file_extension, check_scannable, verdict, analysis, cache_status, options=None):
     # If checking scannability and the QR is not scannable, return JSON response
-    if check_scannable and not is_scannable:
-        from flask import jsonify
-        return jsonify({
-            'scannable': False,
+    if check_scannable and not verdict['scannable']:
+        response = jsonify({
+            **verdict,
             'filename': f"{filename}.{file_extension}",
             'message': "The generated QR code may not be scannable. Please try a different background or color."
         })
+    else:
+        mimetype = 'image/svg+xml' if file_extension == 'svg' else f'image/{file_extension}'
+        response = send_file(img_io, mimetype=mimetype, as_attachment=True, download_name=f"{filename}.{file_extension}")
+        if verdict and verdict.get('quality') is not None:
+            response.headers['X-QR-Quality'] = str(verdict['quality'])
+        if verdict and verdict.get('color'):
+            response.headers['X-QR-Color'] = verdict['color']
+        if options is not None:
+            response.set_etag(result_etag(options))
+            location = permalink(options)
+            if location:
+                response.headers['Content-Location'] = location
+
+    if analysis:
+        response.headers['Server-Timing'] = analysis.server_timing()
+    response.headers['X-Render-Cache'] = cache_status
+    response.headers['Vary'] = 'Accept'
+    return response
+
+@app.route('/qr/<key>.<ext>')
+def qr_permalink(key, ext):
+    """A plain code by URL. key is its render key, so a URL always stands for the same image and
+    can be cached forever; a key that does not match the parameters is a 404."""
+    data = request.args.get('data', '')
+    options = {
+        'data': data,
+        'color': request.args.get('color', '#000000'),
+        'contrast_qr': None,
+        'check_scannable': False,
+        'auto_color': False,
+        'file_extension': ext,
+        'background': None,
+        'background_id': None,
+        'has_background': False,
+    }
+    if ext not in ('png', 'svg') or not data or len(data) > app.config['PERMALINK_MAX_DATA'] or render_key(options) != key:
+        return "Unknown QR code URL", 404
+    g.render_labels = _render_labels(options)
+    immutable = 'public, max-age=31536000, immutable'
+    if key in request.if_none_match:
+        response = Response(status=304)
+    else:
+        try:
+            img_io, _, _, cache_status = run_generate(options)
+        except GenerateError as e:
+            return str(e), e.status, e.headers
+        except Exception as e:
+            return f"Error generating QR code: {e}", 400
+        response = send_file(img_io, mimetype='image/svg+xml' if ext == 'svg' else 'image/png')
+        response.headers['X-Render-Cache'] = cache_status
+    response.set_etag(key)
+    response.headers['Cache-Control'] = immutable
+    return response
+
+@app.route('/assets', methods=['POST'])
+def register_asset():
+    """Registers an uploaded background; /generate then takes its id as background_id."""
+    file = request.files.get('file')
+    try:
+        if app.config['PLAIN_ONLY']:
+            raise GenerateError(PLAIN_ONLY_MESSAGE, 415)
+        if not file:
+            raise GenerateError("No background image provided")
+        file_ext = os.path.splitext(secure_filename(file.filename))[1].lower()
+        if file_ext not in ('.png', '.jpg', '.jpeg', '.gif'):
+            raise GenerateError("Invalid file format. Please upload a PNG, JPG, or GIF image.")
+        background, probe = read_upload(file)
+        # Registering decodes, shrinks and maps every frame, as costly as a render
+        cost = {'has_background': True, 'pixels': probe.decoded_pixels, 'frames': probe.frame_count}
+        with admission.admit(cost, app.config['GENERATE_DEADLINE']):
+            asset, created = asset_registry.register(background, upload_extension(file_ext[1:], probe),
+                                                     request.form.get('data'))
+    except GenerateError as e:
+        return str(e), e.status, e.headers
+    response = jsonify(asset)
+    response.status_code = 201 if created else 200
+    response.headers['Location'] = f"/assets/{asset['id']}"
+    return response
+
+@app.route('/assets/<asset_id>', methods=['GET', 'DELETE'])
+def asset_detail(asset_id):
+    if request.method == 'DELETE':
+        return ('', 204) if asset_registry.delete(asset_id) else ("Unknown background_id", 404)
+    asset = asset_registry.get(asset_id)
+    if asset is None:
+        return "Unknown background_id", 404
+    return jsonify(asset)
+
+# Background shared by every item of a batch, installed once per worker process
+_batch_analysis = None
+
+def _init_batch_worker(analysis):
+    global _batch_analysis
+    _batch_analysis = analysis
+
+# Backgrounds of the batches a pool worker rendered recently, keyed by the file each batch
+# pickled its background to, so a worker loads a batch's background once and not per item
+_batch_backgrounds = OrderedDict()
+
+def _load_batch_background(path):
+    analysis = _batch_backgrounds.get(path)
+    if analysis is None:
+        with open(path, 'rb') as f:
+            analysis = pickle.load(f)
+        _batch_backgrounds[path] = analysis
+        while len(_batch_backgrounds) > max(1, app.config['BATCH_CONCURRENCY']):
+            _batch_backgrounds.popitem(last=False)
+    else:
+        _batch_backgrounds.move_to_end(path)
+    return analysis
+
+def _render_batch_item(index, data, color, background_path, kind, check_scannable):
+    start = time.perf_counter()
+    analysis = _load_batch_background(background_path) if background_path else None
+    img_io, score = render_qr(data, color, analysis, kind, check_scannable)
+    return index, img_io.getvalue(), score, time.perf_counter() - start
+
+_batch_pool = None
+_batch_pool_lock = threading.Lock()
+_batch_slots = threading.BoundedSemaphore(max(1, app.config['BATCH_CONCURRENCY']))
+
+def batch_pool():
+    """The process pool every batch request shares, started on first use.
+
+    Its workers come from a forkserver (spawned where there is none) instead of being forked
+    from this multithreaded server, where a lock held by another thread would stay held forever.
+    """
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is None:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _batch_pool = ProcessPoolExecutor(max_workers=app.config['BATCH_WORKERS'],
+                                              mp_context=multiprocessing.get_context(method))
+        return _batch_pool
+
+def _discard_batch_pool(pool):
+    """Drops a pool that lost a worker, so the next batch starts a new one."""
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is pool:
+            _batch_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def parse_batch_rows(text):
+    """Parses batch rows from a JSON list of objects or a CSV with a header row.
+
+    Each row needs a non-empty `data` string and may set `filename` and `color` strings. Raises
+    ValueError naming the first bad row (counted from 0, as in the archive's summary).
+    """
+    text = text.lstrip('﻿')
+    if text.lstrip().startswith(('[', '{')):
+        rows = json.loads(text)
+        if not isinstance(rows, list):
+            raise ValueError("JSON rows must be a list of objects")
+    else:
+        rows = list(csv.DictReader(io.StringIO(text)))
+    for index, row in enumerate(rows):
+        if not isinstance(row, dict):
+            raise ValueError(f"row {index} is not an object")
+        if not isinstance(row.get('data'), str) or not row['data']:
+            raise ValueError(f"row {index} needs a non-empty 'data' string")
+        for field in ('filename', 'color'):
+            if row.get(field) is not None and not isinstance(row[field], str):
+                raise ValueError(f"row {index} has a '{field}' that is not a string")
+    return rows
+
+class _ZipStream:
+    """Write-only sink for zipfile that hands out what has been written so far."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def _unique_name(name, used):
+    """Returns name, or name with the first free numbered suffix, and records it in used.
+
+    used maps each name handed out to the next suffix to try for it, so a filename repeated many
+    times does not rescan every earlier suffix."""
+    if name not in used:
+        used[name] = 1
+        return name
+    base, ext = os.path.splitext(name)
+    counter = used[name]
+    while f"{base}-{counter}{ext}" in used:
+        counter += 1
+    used[name] = counter + 1
+    unique = f"{base}-{counter}{ext}"
+    used[unique] = 1
+    return unique
+
+def _stream_batch_zip(rows, analysis, kind, default_color, check_scannable):
+    """Renders rows on a process pool and yields a ZIP archive as entries complete."""
+    stream = _ZipStream()
+    archive = zipfile.ZipFile(stream, mode='w', compression=zipfile.ZIP_STORED)
+    used_names = {}
+    latencies = [None] * len(rows)
+    unscannable = []
+    errors = []
+    start = time.perf_counter()
+
+    background_path = None
+    futures = {}
+    pool = batch_pool()
+    try:
+        if analysis is not None:
+            with tempfile.NamedTemporaryFile(prefix='qr-batch-', suffix='.pickle', delete=False) as f:
+                pickle.dump(analysis, f, protocol=pickle.HIGHEST_PROTOCOL)
+                background_path = f.name
+        futures = {
+            pool.submit(_render_batch_item, index, row['data'], row.get('color') or default_color, background_path,
+                        kind, check_scannable): index
+            for index, row in enumerate(rows)
+        }
+        for future in as_completed(futures):
+            index = futures[future]
+            row = rows[index]
+            name = _unique_name(f"{secure_filename(row.get('filename') or '') or f'qr_code_{index + 1}'}.{kind}", used_names)
+            try:
+                _, payload, score, seconds = future.result()
+            except BrokenProcessPool as e:
+                _discard_batch_pool(pool)
+                print(f"Error generating batch item {index}: {e}")
+                errors.append({'row': index, 'error': str(e)})
+                metrics.inc('qr_errors_total', {'where': 'batch_item', 'status': '500'})
+                continue
+            except Exception as e:
+                print(f"Error generating batch item {index}: {e}")
+                errors.append({'row': index, 'error': str(e)})
+                metrics.inc('qr_errors_total', {'where': 'batch_item', 'status': '500'})
+                continue
+            latencies[index] = seconds
+            if score and not score.passed:
+                unscannable.append({'name': name, 'quality': round(score.quality, 3)})
+                metrics.inc('qr_unscannable_total', {'kind': _KIND_LABELS.get(kind, kind)})
+            archive.writestr(name, payload)
+            yield stream.drain()
+    finally:
+        # A client that disconnects must not leave its rows queued ahead of other batches
+        for future in futures:
+            future.cancel()
+        if background_path:
+            os.unlink(background_path)
+
+    elapsed = time.perf_counter() - start
+    done = [seconds for seconds in latencies if seconds is not None]
+    summary = {
+        'items': len(rows),
+        'rendered': len(done),
+        'errors': errors,
+        'unscannable': unscannable,
+        'elapsed_seconds': round(elapsed, 4),
+        'items_per_second': round(len(done) / elapsed, 2) if elapsed else None,
+        'latency_seconds': {
+            'p50': round(float(np.percentile(done, 50)), 4) if done else None,
+            'p95': round(float(np.percentile(done, 95)), 4) if done else None,
+            'max': round(max(done), 4) if done else None,
+        },
+        'per_item_seconds': [round(seconds, 4) if seconds is not None else None for seconds in latencies],
+    }
+    archive.writestr('summary.json', json.dumps(summary, indent=2))
+    archive.close()
+    yield stream.drain()
+
+@app.route('/generate/batch', methods=['POST'])
+def generate_batch():
+    rows_file = request.files.get('rows')
+    rows_text = rows_file.read().decode('utf-8') if rows_file else request.form.get('rows', '')
+    file = request.files.get('file')
+    color = request.form.get('color', '#000000')
+    contrast_qr = request.form.get('contrast_qr')
+    check_scannable = request.form.get('check_scannable', 'false') == 'true'
+    archive_name = secure_filename(request.form.get('filename') or 'qr_codes')
+
+    try:
+        rows = parse_batch_rows(rows_text)
+    except (ValueError, csv.Error) as e:
+        return f"Invalid batch rows: {e}", 400
+    if not rows:
+        return "No rows provided", 400
+    if len(rows) > app.config['BATCH_MAX_ROWS']:
+        return f"Too many rows, the limit is {app.config['BATCH_MAX_ROWS']}", 400
+
+    if not _batch_slots.acquire(blocking=False):
+        return "Too many batches in progress, please retry later.", 503, {'Retry-After': '5'}
+    response = None
+    try:
+        file_extension = 'png'
+        analysis = None
+        if file and app.config['PLAIN_ONLY']:
+            return PLAIN_ONLY_MESSAGE, 415
+        if file:
+            file_ext = os.path.splitext(secure_filename(file.filename))[1].lower()
+            if file_ext not in {'.png', '.jpg', '.jpeg', '.gif'}:
+                return "Invalid file format. Please upload a PNG, JPG, or GIF image.", 400
+            try:
+                background, probe = read_upload(file)
+            except GenerateError as e:
+                return str(e), e.status
+            file_extension = upload_extension(file_ext[1:], probe)
+
+            # Decoded and analysed once here, under admission control like a render, then shared
+            # with every worker. The longest payload (every row was checked to have a data string
+            # above) needs the largest symbol, which sets how far the background can shrink
+            cost = {'has_background': True, 'pixels': probe.decoded_pixels, 'frames': probe.frame_count}
+            try:
+                with admission.admit(cost, app.config['GENERATE_DEADLINE']):
+                    analysis = analyse_background(BytesIO(background), max((row['data'] for row in rows), key=len))
+            except GenerateError as e:
+                return str(e), e.status, e.headers
+            except Exception as e:
+                return f"Error reading background image: {e}", 400
+            if contrast_qr:
+                color = get_opposite_dark_color(analysis)
+
+        response = Response(_stream_batch_zip(rows, analysis, file_extension, color, check_scannable),
+                            mimetype='application/zip',
+                            headers={'Content-Disposition': f'attachment; filename="{archive_name}.zip"'})
+        # The slot is held until the archive has been sent, not just until this view returns
+        response.call_on_close(_batch_slots.release)
+        return response
+    finally:
+        if response is None:
+            _batch_slots.release()
+
+class RenderJob:
+    """A /generate request rendered in the background by JobQueue."""
+
+    def __init__(self, options):
+        self.id = uuid.uuid4().hex
+        self.options = options
+        self.labels = _render_labels(options)
+        self.status = 'queued'
+        self.frames_done = 0
+        self.frames_total = None
+        self.error = None
+        self.error_status = None
+        self.payload = None
+        self.verdict = None
+        self.server_timing = None
+        self.cache_status = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def progress(self, done, total):
+        self.frames_done, self.frames_total = done, total
+
+    def as_dict(self):
+        job = {
+            'id': self.id,
+            'status': self.status,
+            'frames_done': self.frames_done,
+            'frames_total': self.frames_total,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+        if self.status == 'done':
+            job['verdict'] = self.verdict
+            job['result'] = f"/jobs/{self.id}/result"
+        elif self.status == 'failed':
+            job['error'] = self.error
+        return job
+
+class JobQueue:
+    """Runs render jobs on a thread pool, at most max_depth queued or running at once.
+
+    Finished jobs, and their results, are dropped ttl seconds after they finish.
+    """
+
+    def __init__(self, workers, max_depth, ttl):
+        self.workers = workers
+        self.max_depth = max_depth
+        self.ttl = ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._pool = None
+        self._durations = deque(maxlen=50)
+        self.rejected = 0
+        self.expired = 0
+        self.closed = False
+
+    def _active(self):
+        return sum(1 for job in self._jobs.values() if job.finished is None)
+
+    def _evict(self, now):
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job.finished is not None and now - job.finished > self.ttl]:
+            del self._jobs[job_id]
+            self.expired += 1
+
+    def submit(self, options):
+        """Queues a render and returns its RenderJob, or None if the queue is full."""
+        with self._lock:
+            self._evict(time.time())
+            if self.closed or self._active() >= self.max_depth:
+                self.rejected += 1
+                return None
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='render-job')
+            job = RenderJob(options)
+            self._jobs[job.id] = job
+        self._pool.submit(self._run, job)
+        return job
+
+    def _run(self, job):
+        job.started = time.time()
+        job.status = 'running'
+        try:
+            img_io, job.verdict, analysis, job.cache_status = run_generate(job.options, progress=job.progress, job=True)
+            job.payload = img_io.getvalue()
+            if analysis:
+                job.server_timing = analysis.server_timing()
+            job.status = 'done'
+        except GenerateError as e:
+            job.error, job.error_status = str(e), e.status
+            job.status = 'failed'
+        except Exception as e:
+            print(f"Error rendering job {job.id}: {e}")
+            job.error, job.error_status = f"Error rendering QR code: {e}", 500
+            job.status = 'failed'
+        finally:
+            # The upload is not needed any more, only the result
+            job.options = {key: value for key, value in job.options.items() if key != 'background'}
+            job.finished = time.time()
+            with self._lock:
+                self._durations.append(job.finished - job.started)
+        if job.status == 'failed':
+            metrics.inc('qr_errors_total', {'where': 'job', 'status': str(job.error_status)})
+        else:
+            metrics.observe('qr_generate_duration_seconds', job.finished - job.started, job.labels)
+
+    def get(self, job_id):
+        with self._lock:
+            self._evict(time.time())
+            return self._jobs.get(job_id)
+
+    def drain(self):
+        """Stops taking jobs and waits for the queued and running ones to finish."""
+        with self._lock:
+            self.closed = True
+            pool = self._pool
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+    def retry_after(self):
+        """Seconds a client should wait before submitting again, from recent job durations."""
+        with self._lock:
+            if not self._durations:
+                return 1
+            average = sum(self._durations) / len(self._durations)
+        return max(1, math.ceil(average * self._active() / self.workers))
+
+    def stats(self):
+        with self._lock:
+            self._evict(time.time())
+            statuses = [job.status for job in self._jobs.values()]
+            return {
+                'queued': statuses.count('queued'),
+                'running': statuses.count('running'),
+                'done': statuses.count('done'),
+                'failed': statuses.count('failed'),
+                'max_depth': self.max_depth,
+                'rejected': self.rejected,
+                'expired': self.expired,
+            }
 
-    return send_file(img_io, mimetype=f'image/{file_extension}', as_attachment=True, download_name=f"{filename}.{file_extension}")
+job_queue = JobQueue(app.config['JOB_WORKERS'], app.config['JOB_QUEUE_DEPTH'], app.config['JOB_RESULT_TTL'])
 
-if __name__ == '__main__':
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    try:
+        options = read_generate_form()
+    except GenerateError as e:
+        return str(e), e.status
+    job = job_queue.submit(options)
+    if job is None and job_queue.closed:
+        return "Server is shutting down", 503
+    if job is None:
+        return "Too many render jobs queued, please retry later", 429, {'Retry-After': str(job_queue.retry_after())}
+    response = jsonify(job.as_dict())
+    response.status_code = 202
+    response.headers['Location'] = f"/jobs/{job.id}"
+    return response
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return "Unknown or expired job", 404
+    return jsonify(job.as_dict())
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return "Unknown or expired job", 404
+    if job.status == 'failed':
+        return job.error, job.error_status
+    if job.status != 'done':
+        return jsonify(job.as_dict()), 409
+    options = job.options
+    g.render_labels = job.labels
+    response = _qr_response(BytesIO(job.payload), options['filename'], options['file_extension'],
+                            options['check_scannable'], job.verdict, None, job.cache_status, options)
+    if job.server_timing:
+        response.headers['Server-Timing'] = job.server_timing
+    return response
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    elapsed = time.perf_counter() - g.pop('request_start', time.perf_counter())
+    endpoint = request.endpoint or 'unknown'
+    metrics.inc('qr_http_requests_total', {'endpoint': endpoint, 'method': request.method, 'status': str(response.status_code)})
+    metrics.observe('qr_http_request_duration_seconds', elapsed, {'endpoint': endpoint})
+    if response.status_code >= 400:
+        metrics.inc('qr_errors_total', {'where': endpoint, 'status': str(response.status_code)})
+
+    labels = g.get('render_labels')
+    if labels and response.status_code < 400:
+        if endpoint == 'generate_qr':
+            metrics.observe('qr_generate_duration_seconds', elapsed, labels)
+        # The body is written out after this returns, until the server closes the body iterable.
+        # send_file responses are passed through as they are, so wrap the body rather than
+        # using call_on_close, which only runs for bodies the response iterates itself
+        send_start = time.perf_counter()
+        response.response = ClosingIterator(response.response, lambda: observe_stage(
+            'send', time.perf_counter() - send_start, labels['kind'], labels['background'] == 'yes'))
+    return response
+
+@app.route('/metrics')
+def prometheus_metrics():
+    extra = []
+    for name, cache in (('render_cache', render_cache), ('matrix_cache', matrix_cache), ('asset_registry', asset_registry)):
+        cache_stats = cache.stats()
+        extra.append((f'qr_{name}_lookups_total', 'counter', f"{name} lookups by result.",
+                      {(('result', result),): cache_stats[result] for result in ('hits', 'misses') if result in cache_stats}))
+        extra.append((f'qr_{name}_bytes', 'gauge', f"Bytes held by the {name}.", {(): cache_stats['bytes']}))
+    job_stats = job_queue.stats()
+    extra.append(('qr_jobs', 'gauge', "Render jobs by status.",
+                  {(('status', status),): job_stats[status] for status in ('queued', 'running', 'done', 'failed')}))
+    extra.append(('qr_admission_active', 'gauge', "Renders in progress by admission pool.",
+                  {(('pool', pool),): pool_stats['active'] for pool, pool_stats in admission.stats().items()}))
+    extra.append(('qr_jobs_rejected_total', 'counter', "Jobs refused because the queue was full.", {(): job_stats['rejected']}))
+    for name, value in sorted(intake_counters.snapshot().items()):
+        extra.append((f'qr_intake_{name}_total', 'counter', f"Background uploads: {name.replace('_', ' ')}.", {(): value}))
+    return Response(metrics.render(extra), mimetype='text/plain; version=0.0.4')
+
+@app.route('/profiles')
+def list_profiles():
+    """Recent request profiles with their stage breakdown; ?trigger=slow lists only the slow ones."""
+    summaries = profile_store.summaries()
+    trigger = request.args.get('trigger')
+    if trigger:
+        summaries = [summary for summary in summaries if summary['trigger'] == trigger]
+    for summary in summaries:
+        summary['raw'] = f"/profiles/{summary['id']}"
+    return jsonify(summaries)
+
+@app.route('/profiles/<profile_id>')
+def download_profile(profile_id):
+    """The raw profile: a marshalled pstats dump (.prof) or collapsed stacks (.stacks)."""
+    path = profile_store.raw_path(profile_id)
+    if path is None:
+        return "Unknown or expired profile", 404
+    return send_file(path, mimetype='application/octet-stream' if path.endswith('.prof') else 'text/plain',
+                     as_attachment=True, download_name=os.path.basename(path))
+
+@app.route('/stats')
+def stats():
+    return jsonify({'render_cache': render_cache.stats(), 'matrix_cache': matrix_cache.stats(),
+                    'assets': asset_registry.stats(), 'jobs': job_queue.stats(), 'intake': intake_counters.snapshot(),
+                    'admission': admission.stats()})
+
+def _render_bulk_chunk(chunk, kind, check_scannable):
+    results = []
+    for index, data, filename, color in chunk:
+        try:
+            img_io, score = render_qr(data, color, _batch_analysis, kind, check_scannable)
+            results.append((index, filename, img_io.getvalue(), score is None or score.passed, None))
+        except Exception as e:
+            results.append((index, filename, None, False, str(e)))
+    return results
+
+def iter_bulk_rows(path):
+    """Streams (index, row) pairs from a CSV (with header) or JSONL file."""
+    with open(path, newline='', encoding='utf-8') as rows_file:
+        if path.endswith(('.jsonl', '.ndjson')):
+            rows = (json.loads(line) for line in rows_file if line.strip())
+        else:
+            rows = csv.DictReader(rows_file)
+        yield from enumerate(rows)
+
+class BulkOutput:
+    """Writes rendered codes into a directory, a .zip or .tar archive, or a tar stream on stdout ('-')."""
+
+    def __init__(self, target, resume):
+        self.target = target
+        self.archive = None
+        if target == '-':
+            self.archive = tarfile.open(fileobj=sys.stdout.buffer, mode='w|')
+        elif target.endswith('.zip'):
+            if resume and not zipfile.is_zipfile(target):
+                raise zipfile.BadZipFile("the archive was not closed cleanly")
+            self.archive = zipfile.ZipFile(target, mode='a' if resume else 'w')
+        elif target.endswith(('.tar', '.tar.gz', '.tgz')):
+            if resume and target.endswith('.tar'):
+                mode = 'a'
+            else:
+                mode = 'w:gz' if target.endswith(('.gz', '.tgz')) else 'w'
+            self.archive = tarfile.open(target, mode=mode)
+        else:
+            os.makedirs(target, exist_ok=True)
+
+    @property
+    def resumable(self):
+        return self.target != '-' and not self.target.endswith(('.gz', '.tgz'))
+
+    def write(self, name, payload):
+        if isinstance(self.archive, zipfile.ZipFile):
+            self.archive.writestr(name, payload)
+        elif self.archive is not None:
+            info = tarfile.TarInfo(name)
+            info.size = len(payload)
+            info.mtime = int(time.time())
+            self.archive.addfile(info, BytesIO(payload))
+        else:
+            with open(os.path.join(self.target, name), 'wb') as out_file:
+                out_file.write(payload)
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+
+class BulkNames:
+    """Gives each bulk row a unique output name while remembering only explicit filenames.
+
+    Generated names (qr_code_<row>) are unique by construction, so they are never stored; an
+    explicit filename of that form is suffixed instead. Explicit names are appended to a journal
+    next to the checkpoint, which records how much of it belongs to the rendered prefix, so a
+    resumed run continues the same numbering without re-deriving the names of the rows before it."""
+
+    GENERATED = re.compile(r'qr_code_\d+')
+
+    def __init__(self, kind, journal_path=None, journal_size=0):
+        self.kind = kind
+        self.used = {}
+        self.journal = None
+        if journal_path is None:
+            return
+        if journal_size:
+            self.journal = open(journal_path, 'r+b')
+            for line in self.journal.read(journal_size).decode('utf-8').splitlines():
+                self.used.setdefault(line, 1)
+            self.journal.truncate(journal_size)
+            self.journal.seek(journal_size)
+        else:
+            self.journal = open(journal_path, 'wb')
+
+    def name(self, index, filename):
+        if not filename:
+            return f'qr_code_{index + 1}.{self.kind}'
+        name = f'{filename}.{self.kind}'
+        if self.GENERATED.fullmatch(filename):
+            self.used.setdefault(name, 1)
+        name = _unique_name(name, self.used)
+        if self.journal is not None:
+            self.journal.write(f'{name}\n'.encode('utf-8'))
+        return name
+
+    def flush(self):
+        """Flushes the journal and returns its size for the checkpoint."""
+        if self.journal is None:
+            return 0
+        self.journal.flush()
+        return self.journal.tell()
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+
+def _write_checkpoint(path, next_row, rendered, names):
+    with open(path + '.tmp', 'w') as checkpoint_file:
+        json.dump({'next_row': next_row, 'rendered': rendered, 'names': names}, checkpoint_file)
+    os.replace(path + '.tmp', path)
+
+def run_bulk(args):
+    """Renders every row of args.rows into args.out on a process pool, resuming from a checkpoint."""
+    checkpoint_path = args.checkpoint or (None if args.out == '-' else f"{args.out.rstrip('/')}.checkpoint")
+    start_row = rendered = names_size = 0
+    if checkpoint_path and os.path.exists(checkpoint_path) and not args.restart:
+        with open(checkpoint_path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        start_row, rendered, names_size = checkpoint['next_row'], checkpoint['rendered'], checkpoint.get('names', 0)
+        print(f"Resuming from row {start_row} ({rendered} codes already rendered)", file=sys.stderr)
+
+    kind = 'png'
+    color = args.color
+    analysis = None
+    if args.background:
+        kind = os.path.splitext(args.background)[1].lower()[1:]
+        with open(args.background, 'rb') as background_file:
+            analysis = analyse_background(BytesIO(background_file.read()))
+        if args.contrast_qr:
+            color = get_opposite_dark_color(analysis)
+
+    try:
+        output = BulkOutput(args.out, resume=start_row > 0)
+        if start_row and not output.resumable:
+            output.close()
+            raise ValueError("compressed tar files cannot be appended to")
+        names = BulkNames(kind, checkpoint_path + '.names' if checkpoint_path and output.resumable else None,
+                          names_size)
+    except (ValueError, OSError, zipfile.BadZipFile, tarfile.TarError) as e:
+        print(f"Cannot resume into {args.out} ({e}); remove {checkpoint_path} or pass --restart", file=sys.stderr)
+        return 1
+
+    # Treat SIGTERM like Ctrl-C so archives are closed cleanly and the run can be resumed
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    def chunks():
+        chunk = []
+        for index, row in itertools.islice(iter_bulk_rows(args.rows), start_row, None):
+            chunk.append((index, row['data'], secure_filename(row.get('filename') or ''), row.get('color') or color))
+            if len(chunk) == args.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    failed = 0
+    started = last_report = time.perf_counter()
+    session_rendered = 0
+    next_row = start_row
+    pending = deque()
+    chunk_iter = chunks()
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_batch_worker, initargs=(analysis,)) as pool:
+            # Keep a bounded window of chunks in flight and consume them in order, so memory stays
+            # flat for any input size and the checkpoint always marks a contiguous prefix.
+            for chunk in itertools.islice(chunk_iter, args.workers * 2):
+                pending.append((chunk[-1][0], pool.submit(_render_bulk_chunk, chunk, kind, args.check_scannable)))
+            while pending:
+                last_index, future = pending.popleft()
+                for index, filename, payload, is_scannable, error in future.result():
+                    # Repeated filenames get a numbered suffix, as in /generate/batch. Names are given
+                    # out here, in row order, so the journal always matches the checkpointed prefix.
+                    name = names.name(index, filename)
+                    if error:
+                        failed += 1
+                        print(f"Error generating row {index}: {error}", file=sys.stderr)
+                        continue
+                    if args.check_scannable and not is_scannable:
+                        print(f"Row {index} ({name}) may not be scannable", file=sys.stderr)
+                    output.write(name, payload)
+                    rendered += 1
+                    session_rendered += 1
+                next_row = last_index + 1
+                if checkpoint_path and output.resumable:
+                    _write_checkpoint(checkpoint_path, next_row, rendered, names.flush())
+                for chunk in itertools.islice(chunk_iter, 1):
+                    pending.append((chunk[-1][0], pool.submit(_render_bulk_chunk, chunk, kind, args.check_scannable)))
+
+                now = time.perf_counter()
+                if now - last_report >= 5:
+                    print(f"{rendered} codes, {session_rendered / (now - started):.1f} codes/sec", file=sys.stderr)
+                    last_report = now
+    except KeyboardInterrupt:
+        for _, future in pending:
+            future.cancel()
+        output.close()
+        names.close()
+        print(f"Interrupted at row {next_row}; run the same command again to resume", file=sys.stderr)
+        return 130
+
+    output.close()
+    names.close()
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        os.unlink(checkpoint_path)
+    if checkpoint_path and os.path.exists(checkpoint_path + '.names'):
+        os.unlink(checkpoint_path + '.names')
+    elapsed = time.perf_counter() - started
+    print(f"Rendered {session_rendered} codes in {elapsed:.1f}s ({session_rendered / elapsed if elapsed else 0:.1f} codes/sec), "
+          f"{failed} failed", file=sys.stderr)
+    return 1 if failed else 0
+
+def warm_up():
+    """Runs a plain and an artistic render so that imports, segno's tables and the
+    compositor are loaded before the server forks its workers."""
+    start = time.perf_counter()
+    render_qr('https://example.com/warm-up')
+    if app.config['PLAIN_ONLY']:
+        print(f"Warmed up in {time.perf_counter() - start:.2f}s (plain only)")
+        return
+    background = BytesIO()
+    Image.new('RGB', (64, 64), (200, 180, 160)).save(background, format='PNG')
+    render_qr('https://example.com/warm-up', analysis=analyse_background(background), check_scannable=True)
+    print(f"Warmed up in {time.perf_counter() - start:.2f}s")
+
+def serve(args):
+    """Runs the app under gunicorn with preloading, warm-up and graceful shutdown."""
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        print("Error: the production server needs gunicorn (pip install gunicorn)")
+        return 1
+
+    def worker_exit(server, worker):
+        # gunicorn has already finished the in-flight requests, background jobs are ours to wait for
+        job_queue.drain()
+
+    class ProductionServer(BaseApplication):
+        def load_config(self):
+            options = {
+                'bind': args.bind,
+                'workers': args.workers,
+                'threads': args.threads,
+                'worker_class': 'gthread',
+                'timeout': args.timeout,
+                'graceful_timeout': args.graceful_timeout,
+                'preload_app': True,
+                'worker_exit': worker_exit,
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            warm_up()
+            # Move everything allocated so far out of the tracked generations, so the
+            # collector does not touch (and copy) the pages the workers share
+            gc.collect()
+            gc.freeze()
+            return app
+
+    ProductionServer().run()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="QR code generator")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('run', help="run the development server (default)")
+
+    production = subparsers.add_parser('serve', help="run the production server (needs gunicorn)")
+    production.add_argument('--bind', default=os.environ.get('QR_BIND', '0.0.0.0:8000'))
+    production.add_argument('--workers', type=int, default=int(os.environ.get('QR_WORKERS', os.cpu_count() or 1)),
+                            help="worker processes")
+    production.add_argument('--threads', type=int, default=int(os.environ.get('QR_THREADS', 4)),
+                            help="request threads per worker")
+    production.add_argument('--timeout', type=int, default=int(os.environ.get('QR_TIMEOUT', 120)),
+                            help="seconds a request may take before its worker is restarted")
+    production.add_argument('--plain-only', action='store_true', default=app.config['PLAIN_ONLY'],
+                            help="refuse backgrounds and never load the image libraries (QR_PLAIN_ONLY)")
+    production.add_argument('--graceful-timeout', type=int, default=int(os.environ.get('QR_GRACEFUL_TIMEOUT', 60)),
+                            help="seconds to finish in-flight renders on shutdown")
+
+    bulk = subparsers.add_parser('bulk', help="render codes for every row of a CSV or JSONL file")
+    bulk.add_argument('rows', help="CSV file with a header row, or a .jsonl file; needs a 'data' column, "
+                                   "'filename' and 'color' are optional")
+    bulk.add_argument('--out', required=True, help="output directory, .zip, .tar or .tar.gz file, or - for a tar stream on stdout")
+    bulk.add_argument('--background', help="background image shared by every code")
+    bulk.add_argument('--color', default='#000000', help="QR color for rows without one")
+    bulk.add_argument('--contrast-qr', action='store_true', help="pick the QR color from the background")
+    bulk.add_argument('--check-scannable', action='store_true', help="report codes that may not be scannable")
+    bulk.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    bulk.add_argument('--chunk-size', type=int, default=64, help="rows sent to a worker at a time")
+    bulk.add_argument('--checkpoint', help="checkpoint file (default: <out>.checkpoint)")
+    bulk.add_argument('--restart', action='store_true', help="ignore an existing checkpoint")
+
+    args = parser.parse_args(argv)
+    if args.command == 'bulk':
+        return run_bulk(args)
+    if args.command == 'serve':
+        app.config['PLAIN_ONLY'] = args.plain_only
+        return serve(args)
     app.run(debug=True)
+
+if __name__ == '__main__':
+    sys.exit(main())